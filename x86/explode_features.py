@@ -1,11 +1,38 @@
 from enum import Enum
+import array
+import collections
+import concurrent.futures
+import csv
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
 import sqlite3
 import os
 import re
+import select
 import sys
 import struct
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import zipfile
 
 import dataset
+import sqlalchemy
+
+try:
+    import numpy
+except ImportError:
+    # only `rederive` uses numpy, and it gets by without it, just slower.
+    numpy = None
 
 class ParseState(Enum):
     HEADER = 0,
@@ -18,19 +45,89 @@ class ParseState(Enum):
     CPU_SUMMARY = 7
     DONE = 8
 
+# the order registers are kept in, wherever there are four of them.
+REGISTERS = ("eax", "ebx", "ecx", "edx")
+REGISTER_INDEX = dict((reg, i) for (i, reg) in enumerate(REGISTERS))
+
+class CPUIDTable:
+    """one logical cpu's CPUID leaves. the registers of every row are packed
+    four to a row into one `array('I')`; `leaves` maps each leaf to its row
+    number or, for leaves with subleaves, to `{subleaf: row number}`. that's a
+    few small dicts of ints instead of a dict per row."""
+    __slots__ = ("leaves", "regs")
+
+    def __init__(self):
+        self.leaves = {}
+        self.regs = array.array("I")
+
+    def __contains__(self, leaf):
+        return leaf in self.leaves
+
+    def __len__(self):
+        return len(self.regs) // 4
+
+    def has_subleaves(self, leaf):
+        return isinstance(self.leaves.get(leaf), dict)
+
+    def row(self, leaf, subleaf=None):
+        """`(eax, ebx, ecx, edx)` for `leaf`, or `subleaf` of it, or None if
+        that wasn't read."""
+        index = self.leaves.get(leaf)
+        if isinstance(index, dict):
+            index = index.get(subleaf)
+        elif subleaf is not None:
+            return None
+        if index is None:
+            return None
+        regs = self.regs
+        index *= 4
+        return (regs[index], regs[index + 1], regs[index + 2], regs[index + 3])
+
+    def add(self, leaf, subleaf, eax, ebx, ecx, edx):
+        """record a row, replacing any earlier one for the same (sub)leaf. a
+        leaf read both with and without a subleaf has the plain row taken to be
+        subleaf 0."""
+        index = len(self.regs) >> 2
+        self.regs.extend((eax, ebx, ecx, edx))
+        if subleaf is None:
+            self.leaves[leaf] = index
+            return
+        subleaves = self.leaves.get(leaf)
+        if subleaves is None:
+            self.leaves[leaf] = {subleaf: index}
+        elif isinstance(subleaves, dict):
+            subleaves[subleaf] = index
+        else:
+            self.leaves[leaf] = {0: subleaves, subleaf: index}
+
+    def promote(self, leaf):
+        """turn a leaf read without subleaves into one whose only subleaf so
+        far is 0."""
+        self.leaves[leaf] = {0: self.leaves[leaf]}
+
+    def rows(self):
+        """every row, as `(leaf, subleaf, eax, ebx, ecx, edx)` with `subleaf`
+        None for leaves without subleaves."""
+        regs = self.regs
+        for (leaf, index) in self.leaves.items():
+            if isinstance(index, dict):
+                subleaves = index.items()
+            else:
+                subleaves = [(None, index)]
+            for (subleaf, index) in subleaves:
+                index *= 4
+                yield (leaf, subleaf, regs[index], regs[index + 1],
+                    regs[index + 2], regs[index + 3])
+
 class ParsedFeature:
+    __slots__ = ("shortname", "longname", "value", "present")
+
     def __init__(self, shortname, longname, value, present=True):
         self.shortname = shortname
         self.longname = longname
         self.value = value
         self.present = present
 
-    def value(self):
-        if self.present:
-            return self.value
-        else:
-            return None
-
     def show(self):
         return "{}: {}".format(self.shortname, self.value)
 
@@ -41,6 +138,9 @@ class ParsedFeature:
             return "-{}".format(self.shortname)
 
 class CPUIDFeature:
+    __slots__ = ("shortname", "longname", "reg", "offset", "width", "leaf",
+        "subleaf", "filter", "value")
+
     def __init__(self, shortname, longname, leaf, reg, offset, width,
             subleaf=None, filter=None):
         self.shortname = shortname
@@ -59,31 +159,21 @@ class CPUIDFeature:
             return None
 
         # TODO: assume all CPUs report the same cpuid .... for now
-        if self.leaf not in info.cpuid[0]:
+        table = info.cpuid[0]
+        if self.leaf not in table:
             # TOOD: no self.value means we parsed nothing. this probably be a
             # bit more explicit..
             return self.into_non_present()
 
-        top_level = info.cpuid[0][self.leaf]
-        leaf = None
-        if self.subleaf is not None:
-            if self.subleaf in top_level:
-                leaf = top_level[self.subleaf]
-            else:
-                return None
-        else:
-            leaf = top_level
+        if self.subleaf is None and table.has_subleaves(self.leaf):
+            raise Exception("""{:x} has subleaves, but no subleaf was \
+                declared for feature {}""".format(self.leaf, self.shortname))
 
-        if self.reg not in leaf:
-            if not isinstance(leaf, dict):
-                raise Exception("""{} does not describe a subleaf, but leaf \
-                    {:x} has subleaves?""".format(self.shortname, self.leaf))
-            else:
-                raise Exception("""{:x} has subleaves, but no subleaf was \
-                    declared for feature {}""".format(
-                        self.leaf, self.shortname))
+        row = table.row(self.leaf, self.subleaf)
+        if row is None:
+            return None
 
-        reg = leaf[self.reg]
+        reg = row[REGISTER_INDEX[self.reg]]
 
         bits = (reg >> self.offset) & ((1 << self.width) - 1)
 
@@ -108,6 +198,8 @@ class CPUIDFeature:
         )
 
 class CPUIDFCMOV(CPUIDFeature):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("FCMOV", "x87 CMOVcc", None, None, None, 2, None)
 
@@ -115,9 +207,7 @@ class CPUIDFCMOV(CPUIDFeature):
         return self.value == 1
 
     def parse(self, info, db):
-        leaf = info.cpuid[0][0x00000001]
-
-        edx = leaf['edx']
+        edx = info.cpuid[0].row(0x00000001)[3]
 
         present = edx & 0x00008001 == 0x00008001
 
@@ -127,6 +217,8 @@ class CPUIDFCMOV(CPUIDFeature):
             self.value = 0
 
 class CPUIDBoolFeature(CPUIDFeature):
+    __slots__ = ()
+
     def __init__(self, shortname, longname, leaf, reg, offset, subleaf=None):
         super().__init__(shortname, longname, leaf, reg, offset, 1, subleaf)
 
@@ -137,6 +229,54 @@ class CPUIDBoolFeature(CPUIDFeature):
         if self.value == 1:
             return self.shortname
 
+class MSRFeature:
+    """a bitfield of a model-specific register, like `CPUIDFeature` is of a
+    CPUID register. AIDA only lists MSRs it managed to read, so one that isn't
+    in a dump is not present rather than zero."""
+    __slots__ = ("shortname", "longname", "msr", "offset", "width", "filter")
+
+    def __init__(self, shortname, longname, msr, offset, width, filter=None):
+        self.shortname = shortname
+        self.longname = longname
+        self.msr = msr
+        self.offset = offset
+        self.width = width
+        self.filter = filter
+
+    def parse(self, info, db):
+        if self.filter and not self.filter(info):
+            return None
+
+        # TODO: like CPUID, assume all CPUs read the same .... for now
+        value = info.msr(self.msr)
+        if value is None:
+            return self.into_non_present()
+
+        bits = (value >> self.offset) & ((1 << self.width) - 1)
+
+        return self.into_present(bits)
+
+    def into_non_present(self):
+        return ParsedFeature(
+            self.shortname,
+            self.longname,
+            None,
+            present=False
+        )
+
+    def into_present(self, value):
+        return ParsedFeature(
+            self.shortname,
+            self.longname,
+            value,
+        )
+
+class MSRBoolFeature(MSRFeature):
+    __slots__ = ()
+
+    def __init__(self, shortname, longname, msr, offset, filter=None):
+        super().__init__(shortname, longname, msr, offset, 1, filter)
+
 AMD_CPU_PRODUCT_INFO = {
     "Am5x86": {
         "datasheet": "https://datasheets.chipdb.org/AMD/486_5x86/19751C.pdf",
@@ -155,20 +295,137 @@ class CPUIDVendor:
         self.longname = "CPUID-defined vendor string from leaf 0h"
 
     def parse(self, info, db):
-        if 0x00000000 not in info.cpuid[0]:
+        brand = info.cpuid[0].row(0x00000000)
+        if brand is None:
             return None
 
-        brand = info.cpuid[0][0x00000000]
-
         # yes it's in b, d, c order.
-        vendorname = struct.pack("<III", brand['ebx'], brand['edx'],
-                brand['ecx'])
+        (_, ebx, ecx, edx) = brand
+        vendorname = struct.pack("<III", ebx, edx, ecx)
 
         info.add_feature(ParsedFeature(
             self.shortname, self.longname, vendorname.decode("utf8")
         ))
 
+# a row of `uarches`, with the name of its family.
+Uarch = collections.namedtuple("Uarch", "id name family family_name")
+
+class UarchResolver:
+    """`family_model_info`, `uarches` and `families`, read once into a table per
+    vendor that's indexed directly by the family and model fields of CPUID leaf
+    1 eax. `query` runs a query and returns rows indexed by column name: the
+    `query` of a `dataset` database, or the `execute` of a sqlite3 connection
+    whose `row_factory` is `sqlite3.Row`.
+
+    `classify` and `classify_many` are meant for mapping lots of raw CPUID
+    signatures (like fleet telemetry) to uarches; no SQL is run after this is
+    constructed."""
+    # family and model fields of leaf 1 eax: model in 7:4, family in 11:8,
+    # extended model in 19:16 and extended family in 27:20. stepping and
+    # processor type don't matter here.
+    SIGNATURE_BITS = 20
+
+    @staticmethod
+    def signature_index(leaf1_eax):
+        """leaf 1 eax -> `ext_family:ext_model:family:model`, the index into a
+        vendor's table."""
+        return ((leaf1_eax >> 4) & 0xff) | ((leaf1_eax >> 8) & 0xfff00)
+
+    def __init__(self, query):
+        families = dict((row['id'], row['name']) for row in
+            query("select id, name from families"))
+        # `self.uarches[id]` is the `Uarch` with that id, or None where there
+        # isn't one. index 0 is never a uarch, so it means "unknown" below.
+        uarches = list(query("select id, name, family from uarches"))
+        self.uarches = [None] * (max([row['id'] for row in uarches] + [0]) + 1)
+        for row in uarches:
+            self.uarches[row['id']] = Uarch(row['id'], row['name'],
+                row['family'], families.get(row['family']))
+
+        # vendors are known by both their name ("Intel") and CPUID vendor
+        # string ("GenuineIntel").
+        self.signatures = {}
+        for row in query("select id, name, brandstring from vendors"):
+            table = array.array("H", bytes(2 << self.SIGNATURE_BITS))
+            self.signatures[row['id']] = table
+            self.signatures[row['name']] = table
+            self.signatures[row['brandstring']] = table
+
+        # a few family/model combinations are listed twice. the first listed
+        # is what the old per-cpu query found, so that one wins.
+        for row in query("""select vendor, family, ext_family, model,
+                ext_model, uarch from family_model_info order by id"""):
+            index = (row['ext_family'] << 12) | (row['ext_model'] << 8) | \
+                (row['family'] << 4) | row['model']
+            table = self.signatures[row['vendor']]
+            if not table[index]:
+                table[index] = row['uarch']
+
+    def lookup(self, vendor, family, ext_family, model, ext_model):
+        """the `Uarch` with these family and model fields, or None."""
+        table = self.signatures.get(vendor)
+        if table is None:
+            return None
+        return self.uarches[table[
+            (ext_family << 12) | (ext_model << 8) | (family << 4) | model]]
+
+    def classify(self, vendor, leaf1_eax):
+        """the `Uarch` of a processor from `vendor` whose CPUID leaf 1 eax is
+        `leaf1_eax`, or None if it's not one we know of."""
+        table = self.signatures.get(vendor)
+        if table is None:
+            return None
+        return self.uarches[table[
+            ((leaf1_eax >> 4) & 0xff) | ((leaf1_eax >> 8) & 0xfff00)]]
+
+    def classify_many(self, vendor, leaf1_eaxes):
+        """`classify` for every leaf 1 eax in `leaf1_eaxes`, all from `vendor`.
+        with numpy, the table lookups are done all at once."""
+        table = self.signatures.get(vendor)
+        if table is None:
+            return [None] * len(leaf1_eaxes)
+        uarches = self.uarches
+        if numpy is None:
+            return [uarches[table[((eax >> 4) & 0xff) | ((eax >> 8) & 0xfff00)]]
+                for eax in leaf1_eaxes]
+        eaxes = numpy.asarray(leaf1_eaxes, dtype=numpy.uint32)
+        indexes = ((eaxes >> 4) & 0xff) | ((eaxes >> 8) & 0xfff00)
+        ids = numpy.frombuffer(table, dtype=numpy.uint16)[indexes]
+        return [uarches[i] for i in ids.tolist()]
+
+def classify(vendor, leaf1_eax, db=None):
+    """the `Uarch` for CPUID vendor string `vendor` and CPUID leaf 1 eax
+    `leaf1_eax`, per the `family_model_info` in `db` (a `dataset` database), or
+    in `product_info.sql` if there's no `db`. None if it isn't known."""
+    return uarch_resolver(db).classify(vendor, leaf1_eax)
+
+# `(db, UarchResolver)` for whichever database was last resolved against. the
+# product info tables don't change once a database is set up, so one resolver
+# lasts as long as its database does.
+_uarch_resolver = (None, None)
+
+def uarch_resolver(db=None):
+    """the `UarchResolver` for `db`, or for the `product_info_template` if `db`
+    is None. built once and reused while `db` is."""
+    global _uarch_resolver
+    (resolver_db, resolver) = _uarch_resolver
+    if resolver is None or resolver_db is not db:
+        if db is None:
+            connection = sqlite3.connect(product_info_template())
+            connection.row_factory = sqlite3.Row
+            resolver = UarchResolver(connection.execute)
+            connection.close()
+        else:
+            resolver = UarchResolver(db.query)
+        _uarch_resolver = (db, resolver)
+    return resolver
+
 class CPUIDUarch:
+    # looking up a uarch needs `family_model_info`, so when `AIDAInfo` is built
+    # without a database (parallel ingest parses in worker processes) this is
+    # put off until `AIDAInfo.resolve`.
+    needs_db = True
+
     def __init__(self):
         self.shortname = "uarch"
         self.longname = """Microarchitecture of the processor as informed by \
@@ -178,95 +435,44 @@ class CPUIDUarch:
         if 0x00000000 not in info.cpuid[0]:
             return None
 
-        brand = info.cpuid[0][0x00000000]
-
         vendorname = info.feature("vendor").value
 
-        uarch = None
-
-        if vendorname == "AuthenticAMD":
-            uarch = self.parse_amd(info, db)
-        elif vendorname == "GenuineIntel":
-            uarch = self.parse_intel(info, db)
-#        else:
-#            print("""cannot currently handle processors from vendor \
-#                    {}""".format(vendorname))
-
-        if uarch is None:
+        # only AMD and Intel have their family and model numbers mapped out.
+        if vendorname not in ("AuthenticAMD", "GenuineIntel"):
             return
 
-        info.add_feature(ParsedFeature(
-            "uarch", "CPUID-implied processor architecture",
-            uarch
-        ))
-
-        info.add_feature(ParsedFeature(
-            "family", "CPUID-implied processor family",
-            db['uarches'].find_one(id=uarch)['family']
-        ))
-
-
-    def parse_intel(self, info, db):
         family = info.feature("FamilyID").value
         ext_family = info.feature("ExtendedFamilyID").value
-
         model = info.feature("ModelID").value
         ext_model = info.feature("ExtendedModelID").value
 
-        fm = db.query("""\
-            select uarch from family_model_info join vendors on
-            family_model_info.vendor = vendors.id \
-            where \
-                vendors.name="Intel" and \
-                family_model_info.family={} and \
-                family_model_info.ext_family={} and \
-                family_model_info.model={} and \
-                family_model_info.ext_model={}""".format(
-            family, ext_family, model, ext_model))
+        uarch = uarch_resolver(db).lookup(vendorname, family, ext_family, model,
+            ext_model)
 
-        try:
-            fm = fm.next()
-            fm = fm['uarch']
-            return fm
-        except:
+        if uarch is None:
             print("unknown family and/or model: {:x}h+{:x}h/{:x}h+{:x}".format(
                 family, ext_family,
                 model, ext_model))
             print("  {}".format(info.cpuid_name))
+            return
 
-    def parse_amd(self, info, db):
-        family = info.feature("FamilyID").value
-        ext_family = info.feature("ExtendedFamilyID").value
-
-        model = info.feature("ModelID").value
-        ext_model = info.feature("ExtendedModelID").value
-
-        fm = db.query("""\
-            select uarch from family_model_info join vendors on
-            family_model_info.vendor = vendors.id \
-            where \
-                vendors.name="AMD" and \
-                family_model_info.family={} and \
-                family_model_info.ext_family={} and \
-                family_model_info.model={} and \
-                family_model_info.ext_model={}""".format(
-            family, ext_family, model, ext_model))
+        info.add_feature(ParsedFeature(
+            "uarch", "CPUID-implied processor architecture",
+            uarch.id
+        ))
 
-        try:
-            fm = fm.next()
-            fm = fm['uarch']
-            return fm
-        except:
-            print("unknown family and/or model: {:x}h+{:x}h/{:x}h+{:x}".format(
-                family, ext_family,
-                model, ext_model))
-            print("  {}".format(info.cpuid_name))
+        info.add_feature(ParsedFeature(
+            "family", "CPUID-implied processor family",
+            uarch.family
+        ))
 
 ISA_EXTENSIONS = [
     # the following are from the AMD Architecture Programmer's Manual Volume 3,
     # table D2. Document 24594 Rev 3.36 (March 2024).
     CPUIDBoolFeature("3DNow", "3DNow!", 0x80000001, "edx", 31),
     CPUIDBoolFeature("3DNowExt", "3DNow! Extensions", 0x80000001, "edx", 30),
+    # PREFETCH/PREFETCHW are there if any of 3DNowPrefetch, LM or 3DNow are,
+    # so this is defined on all three bits. see `ALTERNATE_DEFINITIONS`.
     CPUIDBoolFeature("3DNowPrefetch", """Prefetch instructions from 3DNow!, \
     PREFETCH and PREFETCHW""", 0x80000001, "ecx", 8),
     CPUIDBoolFeature("3DNowPrefetch", """Prefetch instructions from 3DNow!, \
@@ -284,8 +490,6 @@ ISA_EXTENSIONS = [
     # distinct from CLFSH?? and the APM also reports this at eax=7 ecx=0 bit 24
     # like SDM..
     CPUIDBoolFeature("CLWB", "CLWB", 0x80000008, "ebx", 0),
-    CPUIDBoolFeature("F16C", "16-bit floating-point conversion", 0x00000001,
-        "ecx", 29),
     CPUIDBoolFeature("FMA4", "FMA4", 0x80000001, "ecx", 16),
     CPUIDBoolFeature("FPU", "x87", 0x80000001, "edx", 0),
     CPUIDBoolFeature("INVLPGB", "INVLPGB/TLBSYNC", 0x80000008, "ebx", 3),
@@ -370,7 +574,7 @@ ISA_EXTENSIONS = [
     CPUIDBoolFeature("MOVDIR64B", "MOVDIR64B supported", 0x00000007,
         "ecx", 28, subleaf=0),
     CPUIDBoolFeature("ENQCMD", "Enqueue Stores support (ENQCMD instruction)",
-        0x00000007, "ecx", 28, subleaf=0),
+        0x00000007, "ecx", 29, subleaf=0),
 
     CPUIDBoolFeature("AVX512_4VNNIW", "AVX512_4VNNIW",
         0x00000007, "edx", 2, subleaf=0),
@@ -468,9 +672,8 @@ INTEL_FEATURES = [
         0x00000005, "eax", 0, 16),
     CPUIDFeature("monitor-max", "maximum size of a MONITOR line in bytes",
         0x00000005, "ebx", 0, 16),
-    CPUIDFeature("mwait-break-on-int", """mwait can be set to break on \
-        interrupt even when interrupts are disabled""", 0x00000005, "ebx", \
-        0, 16),
+    CPUIDBoolFeature("mwait-break-on-int", """mwait can be set to break on \
+        interrupt even when interrupts are disabled""", 0x00000005, "ecx", 1),
     CPUIDFeature("C0 substates", """Number of supported C0 sub-states \
         supported by MWAIT""", 0x00000005, "edx", 0, 4),
     CPUIDFeature("C1 substates", """Number of supported C1 sub-states \
@@ -540,12 +743,255 @@ FEATURES = [
         "eax", 2, subleaf=1)
 ]
 
+# features read out of MSRs rather than CPUID. these are only as good as the set
+# of MSRs AIDA happened to read for a given dump, and older dumps have none.
+MSR_FEATURES = [
+    # IA32_ARCH_CAPABILITIES, from the Intel SDM volume 4, table 2-2. it's
+    # enumerated by CPUID.(EAX=7,ECX=0):EDX[29], but it's only in a dump at
+    # all if it could be read.
+    MSRBoolFeature("RDCL_NO", "not susceptible to Rogue Data Cache Load",
+        0x0000010a, 0),
+    MSRBoolFeature("IBRS_ALL", "enhanced IBRS", 0x0000010a, 1),
+    MSRBoolFeature("RSBA", """RET may be predicted from the BTB when the RSB is \
+        empty""", 0x0000010a, 2),
+    MSRBoolFeature("SKIP_L1DFL_VMENTRY", """no need to flush L1D on VM \
+        entry""", 0x0000010a, 3),
+    MSRBoolFeature("SSB_NO", "not susceptible to Speculative Store Bypass",
+        0x0000010a, 4),
+    MSRBoolFeature("MDS_NO", """not susceptible to Microarchitectural Data \
+        Sampling""", 0x0000010a, 5),
+    MSRBoolFeature("IF_PSCHANGE_MC_NO", """no machine check from changing a \
+        page's size without TLB invalidation""", 0x0000010a, 6),
+    MSRBoolFeature("TSX_CTRL", "IA32_TSX_CTRL is supported", 0x0000010a, 7),
+    MSRBoolFeature("TAA_NO", "not susceptible to TSX Asynchronous Abort",
+        0x0000010a, 8),
+
+    # MSR_PLATFORM_INFO. not architectural, but it's been here with this
+    # layout since Nehalem.
+    MSRFeature("max non-turbo ratio", """maximum non-turbo ratio, in multiples \
+        of the bus clock""", 0x000000ce, 8, 8),
+]
+
 FEATURES += ISA_EXTENSIONS
+FEATURES += INTEL_FEATURES
+FEATURES += MSR_FEATURES
+
+# names that are meant to be defined in more than one place, and so to overlap
+# whatever else is on those bits. `FeaturePlan.problems` only notes these.
+ALTERNATE_DEFINITIONS = {"3DNowPrefetch"}
+
+class FeaturePlan:
+    """`FEATURES`, compiled once into the order they're evaluated in. plain
+    `CPUIDFeature`s are grouped by the register they read, so each register is
+    looked up once per cpu and all of its bitfields are pulled out together.
+    everything else (vendor, uarch, FCMOV, MSRs...) is parsed one at a time
+    afterward, in `FEATURES` order, since those look at features before them.
+
+    features that share a shortname are alternative ways of telling the same
+    thing, like the several bits that each imply 3DNow! prefetch; see
+    `AIDAInfo.add_feature` for how they're combined."""
+    def __init__(self, features):
+        # `{(leaf, subleaf, reg): [(feature, offset, mask), ...]}`
+        self.registers = {}
+        self.others = []
+        for feature in features:
+            if type(feature) in (CPUIDFeature, CPUIDBoolFeature) and \
+                    feature.filter is None:
+                key = (feature.leaf, feature.subleaf, feature.reg)
+                self.registers.setdefault(key, []).append(
+                    (feature, feature.offset, (1 << feature.width) - 1))
+            else:
+                self.others.append(feature)
+
+        # shortnames of the features that are only ever a single bit, in the
+        # order they're first defined. these are what `cpus.feature_mask`
+        # has a bit for.
+        widths = {}
+        for feature in features:
+            widths.setdefault(feature.shortname, set()).add(
+                getattr(feature, "width", None))
+        self.bool_features = [name for (name, width) in widths.items()
+            if width == {1}]
+
+    def problems(self):
+        """describe definitions that repeat or overlap each other: the same
+        bits under two names, the same name for the same bits twice, and names
+        defined over more than one place. returns `(problems, notes)`, where
+        `notes` are the ones that come of `ALTERNATE_DEFINITIONS`, and so are
+        intended."""
+        problems = []
+        notes = []
+        places = {}
+        for ((leaf, subleaf, reg), fields) in self.registers.items():
+            where = "leaf {:x}h{} {}".format(leaf,
+                "" if subleaf is None else " subleaf {}".format(subleaf), reg)
+            for (i, (feature, offset, mask)) in enumerate(fields):
+                bits = mask << offset
+                if feature.width == 1:
+                    place = "{} bit {}".format(where, offset)
+                else:
+                    place = "{} bits {}-{}".format(where, offset,
+                        offset + feature.width - 1)
+                places.setdefault(feature.shortname, []).append(place)
+                for (other, other_offset, other_mask) in fields[:i]:
+                    if not bits & (other_mask << other_offset):
+                        continue
+                    if other.shortname == feature.shortname:
+                        if (offset, mask) == (other_offset, other_mask):
+                            problems.append("{} is defined twice, at {}".format(
+                                feature.shortname, places[feature.shortname][-1]))
+                    else:
+                        found = notes if ALTERNATE_DEFINITIONS & \
+                            {other.shortname, feature.shortname} else problems
+                        found.append("{} and {} overlap at {}".format(
+                            other.shortname, feature.shortname, where))
+        for (shortname, where) in places.items():
+            if len(set(where)) > 1:
+                found = notes if shortname in ALTERNATE_DEFINITIONS else \
+                    problems
+                found.append("{} is defined in {} places: {}".format(
+                    shortname, len(set(where)), ", ".join(where)))
+        return (problems, notes)
+
+    def evaluate(self, info, db, batch=None):
+        """parse every feature into `info`. `batch` is a `FeatureMatrix` that
+        may already have the register bitfields for `info`'s table."""
+        table = info.cpuid[0]
+        parsed = batch.features(table) if batch is not None else None
+        if parsed is not None:
+            for feature in parsed:
+                info.add_feature(feature)
+        else:
+            self.evaluate_registers(info, table)
 
+        for feature in self.others:
+            if db is None and getattr(feature, "needs_db", False):
+                info.unresolved_features.append(feature)
+                continue
+            parsed = feature.parse(info, db)
+            if parsed:
+                info.add_feature(parsed)
+
+    def evaluate_registers(self, info, table):
+        for ((leaf, subleaf, reg), fields) in self.registers.items():
+            if leaf not in table:
+                for (feature, _, _) in fields:
+                    info.add_feature(feature.into_non_present())
+                continue
+            if subleaf is None and table.has_subleaves(leaf):
+                raise Exception("""{:x} has subleaves, but no subleaf was \
+                    declared for feature {}""".format(
+                        leaf, fields[0][0].shortname))
+            row = table.row(leaf, subleaf)
+            if row is None:
+                continue
+            value = row[REGISTER_INDEX[reg]]
+            for (feature, offset, mask) in fields:
+                info.add_feature(feature.into_present((value >> offset) & mask))
+
+# compiled after every list of features has been added to `FEATURES`.
+FEATURE_PLAN = FeaturePlan(FEATURES)
+
+class FeatureMatrix:
+    """a `FeaturePlan`'s register bitfields, evaluated for many CPUID tables at
+    once. the registers the plan reads are gathered into an
+    `(n tables, n registers)` uint32 matrix, and every bitfield of every table
+    is then one shift and mask over it. this needs numpy, so check `available()`
+    first; `FeaturePlan.evaluate` does the same one table at a time."""
+    @staticmethod
+    def available():
+        return numpy is not None
+
+    # what a table has of a register the plan reads.
+    NO_LEAF = 0
+    NO_SUBLEAF = 1
+    READ = 2
+
+    def __init__(self, plan, tables):
+        self.tables = list(tables)
+        self.index = dict((id(table), i) for (i, table) in
+            enumerate(self.tables))
+        self.parsed = {}
+
+        keys = list(plan.registers)
+        registers = numpy.zeros((len(self.tables), len(keys)),
+            dtype=numpy.uint32)
+        states = numpy.zeros((len(self.tables), len(keys)), dtype=numpy.uint8)
+        for (i, table) in enumerate(self.tables):
+            for (j, (leaf, subleaf, reg)) in enumerate(keys):
+                if leaf not in table:
+                    continue
+                if subleaf is None and table.has_subleaves(leaf):
+                    raise Exception("""{:x} has subleaves, but no subleaf was \
+                        declared for feature {}""".format(
+                            leaf, plan.registers[keys[j]][0][0].shortname))
+                row = table.row(leaf, subleaf)
+                if row is None:
+                    states[i, j] = self.NO_SUBLEAF
+                    continue
+                registers[i, j] = row[REGISTER_INDEX[reg]]
+                states[i, j] = self.READ
+
+        # one column per bitfield, in the order `FeaturePlan.evaluate` would
+        # parse them, so same-named features combine the same way.
+        self.fields = []
+        columns = []
+        offsets = []
+        masks = []
+        for (j, key) in enumerate(keys):
+            for (feature, offset, mask) in plan.registers[key]:
+                self.fields.append(feature)
+                columns.append(j)
+                offsets.append(offset)
+                masks.append(mask)
+        columns = numpy.array(columns, dtype=numpy.intp)
+        values = (registers[:, columns] >>
+            numpy.array(offsets, dtype=numpy.uint32)) & \
+            numpy.array(masks, dtype=numpy.uint32)
+        states = states[:, columns]
+
+        # tables mostly differ in things no feature reads (brand strings, cache
+        # sizes...), so plenty of them come out the same. keep each distinct
+        # row once, and which of those each table has.
+        (self.rows, self.row_of) = numpy.unique(
+            numpy.hstack((values, states)), axis=0, return_inverse=True)
+        self.row_of = self.row_of.reshape(-1).tolist()
+
+    def features(self, table):
+        """the `ParsedFeature`s for the bitfields of `table`, or None if it
+        wasn't one of the tables this was built for. tables with the same
+        bitfields share one list."""
+        i = self.index.get(id(table))
+        if i is None:
+            return None
+        row = self.row_of[i]
+        parsed = self.parsed.get(row)
+        if parsed is None:
+            parsed = self.parsed[row] = []
+            fields = self.rows[row].tolist()
+            for (feature, value, state) in zip(self.fields,
+                    fields, fields[len(self.fields):]):
+                if state == self.READ:
+                    parsed.append(feature.into_present(value))
+                elif state == self.NO_LEAF:
+                    parsed.append(feature.into_non_present())
+        return parsed
+
+# section headers that are matched exactly...
 section_headers = {
         "------[ Versions ]------": ("versions", ParseState.VERSION),
         "------[ CPU Info ]------": ("aida_cpuid", ParseState.AIDA_CPUID),
         "------[ Motherboard Info ]------": ("motherboard_info", ParseState.MOTHERBOARD),
+        "------[ All CPUs ]------": ("cpus_summary", ParseState.DONE),
+        "------[ MSR Registers ]------": ("msrs", ParseState.MSRS),
+        # `AuthenticAMD0040F12_K8_SantaRosa_CPUID_S8.txt` only has one MSR block
+        # to go with the 16 CPUs..
+        "MSR Registers": ("msrs", ParseState.MSRS),
+}
+
+# ... and section headers that are patterns. if a pattern has a group, it's the
+# cpu/thread number the header describes.
+section_header_patterns = {
         "------\[ CPUID Registers / Logical CPU #(\d+) \]------": ("cpuid", ParseState.CPUID),
         "CPUID Registers \(CPU #(\d+)\)": ("cpuid", ParseState.CPUID),
         # for some files, SMT twins are indicated by a slightly different header
@@ -557,13 +1003,8 @@ section_headers = {
         # on cpuid regions, which include an indicator of cpu number but not
         # really an explicit statement. we'll do some fixup on these...
         "Group: 0x00 Affinity mask: 0x[0-9A-F]+": ("cpuid", ParseState.CPUID),
-        "------[ All CPUs ]------": ("cpus_summary", ParseState.DONE),
         "------\[ MSR Registers / Logical CPU #([0-9]+) \]------": ("msrs", ParseState.MSRS),
-        "------[ MSR Registers ]------": ("msrs", ParseState.MSRS),
         "MSR Registers \(CPU #(\d+)\)": ("msrs", ParseState.MSRS),
-        # `AuthenticAMD0040F12_K8_SantaRosa_CPUID_S8.txt` only has one MSR block
-        # to go with the 16 CPUs..
-        "MSR Registers": ("msrs", ParseState.MSRS),
         "PerformanceFrequency =.*": ("remainder", ParseState.REMAINDER)
 }
 
@@ -657,16 +1098,233 @@ motherboard_lines = {
     "DMI BIOS Version    :": "bios_version",
 }
 
-class AIDAInfo:
-    def feature(self, name):
-        for feat in self.parsed_features:
-            if feat.shortname == name:
-                return feat
+# the header patterns are tried as one alternation, in the order above. each
+# pattern is wrapped in a group `h<n>` so `lastgroup` says which one matched,
+# and `section_header_cpu_groups` has the index of its cpu number group, if any.
+section_header_re = None
+section_header_cpu_groups = []
+
+def compile_section_headers():
+    global section_header_re
+    alternatives = []
+    group = 1
+    for (i, (pattern, (name, state))) in \
+            enumerate(section_header_patterns.items()):
+        alternatives.append("(?P<h{}>{})".format(i, pattern))
+        inner_groups = re.compile(pattern).groups
+        section_header_cpu_groups.append(
+            (name, state, group + 1 if inner_groups else None))
+        group += 1 + inner_groups
+    section_header_re = re.compile("|".join(alternatives))
+
+compile_section_headers()
+
+def match_section_header(line):
+    """if `line` is a section header, return `(name, state, cpu)` where `cpu` is
+    the cpu/thread number text from the header, if it has one."""
+    header = section_headers.get(line)
+    if header:
+        return header + (None,)
+
+    match = section_header_re.match(line)
+    if not match:
+        return None
 
+    (name, state, cpu_group) = section_header_cpu_groups[
+        int(match.lastgroup[1:])]
+    return (name, state,
+        match.group(cpu_group) if cpu_group is not None else None)
+
+def label_key(label):
+    """AIDA pads labels with spaces to line up their colons, and how much padding
+    depends on the AIDA version. so, labels are looked up by their words."""
+    return " ".join(label.split())
+
+def compile_label_table(lines):
+    table = {}
+    for (prefix, desc) in lines.items():
+        key = label_key(prefix[:prefix.rindex(":")])
+        if table.get(key, desc) != desc:
+            raise Exception("conflicting descriptions for label '{}'".format(
+                key))
+        table[key] = desc
+    return table
+
+version_labels = compile_label_table(version_lines)
+aida_cpu_labels = compile_label_table(aida_cpu_lines)
+motherboard_labels = compile_label_table(motherboard_lines)
+
+def match_label(labels, line):
+    """for a `{label}: {value}` line with a label in `labels`, return
+    `(desc, value)`."""
+    (label, sep, _) = line.partition(":")
+    if not sep:
+        return None
+    desc = labels.get(label_key(label))
+    if desc is None:
         return None
+    # the colon is followed by a space, even if the value is empty.
+    return (desc, line[len(label) + 2:])
+
+core_location_re = re.compile(
+    "allcpu: Package (\\d+) / Core (\\d+) / Thread (\\d+): (.*)")
+cache_summary_re = re.compile("L\\d .*Cache:")
+virtual_cpu_header_re = re.compile("CPUID Registers \\(CPU .* Virtual\\)")
+
+# CPUID register rows come in a few dialects, though any one file sticks to one.
+# `AIDAInfo` works out which from the first row and uses that scanner for the
+# rest, only retrying every dialect if that one doesn't match. each scanner
+# returns `(leaf, subleaf, eax, ebx, ecx, edx)`, or None if the line isn't a row
+# in its dialect.
+
+cpuid_subleaf_re = re.compile(" \\[SL ([0-9A-F]+)\\]")
+
+def cpuid_row_subleaf(misc_info):
+    # the `[SL nn]` suffix, if there is one, says which subleaf a row is for.
+    # rows might have other bracketed suffixes too.
+    if "[SL " not in misc_info:
+        return None
+    return int(cpuid_subleaf_re.findall(misc_info)[-1], 16)
+
+def fixed_width_cpuid_row_scanner(leaf_sep, reg_sep):
+    """rows where every field is exactly 8 hex digits can be sliced apart at
+    fixed offsets:
+    `CPUID LLLLLLLL{leaf_sep}AAAAAAAA{reg_sep}BBBBBBBB{reg_sep}...`"""
+    def scan(line):
+        if len(line) < 51 or line[14:16] != leaf_sep or \
+                line[24] != reg_sep or line[33] != reg_sep or \
+                line[42] != reg_sep or not line.startswith("CPUID "):
+            return None
+        try:
+            return (
+                int(line[6:14], 16),
+                cpuid_row_subleaf(line[51:]),
+                int(line[16:24], 16),
+                int(line[25:33], 16),
+                int(line[34:42], 16),
+                int(line[43:51], 16),
+            )
+        except ValueError:
+            return None
+    return scan
+
+# or otherwise, maybe it's `CPUID  \t{regs}`. some older Intel CPUID readings
+# were like that, and the whitespace isn't always the same width.
+whitespace_cpuid_row_re = re.compile(
+    "CPUID ([0-9A-F]{8})\\s+([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})( .*)?")
+
+def scan_whitespace_cpuid_row(line):
+    leaf_info = whitespace_cpuid_row_re.match(line)
+    if not leaf_info:
+        return None
+    return (
+        int(leaf_info.group(1), 16),
+        cpuid_row_subleaf(leaf_info.group(6) or ""),
+        int(leaf_info.group(2), 16),
+        int(leaf_info.group(3), 16),
+        int(leaf_info.group(4), 16),
+        int(leaf_info.group(5), 16),
+    )
+
+# in the order dialects are tried when sniffing.
+cpuid_row_scanners = [
+    # `CPUID 00000001: 00A20F10-00100800-7EF8320B-178BFBFF [SL 00]`
+    fixed_width_cpuid_row_scanner(": ", "-"),
+    scan_whitespace_cpuid_row,
+    # some AMD summaries use space separators instead of hypen?
+    fixed_width_cpuid_row_scanner(": ", " "),
+    # `AuthenticAMD0500F20_K14_Bobcat_CPUID.txt` has the colon in a weird spot.
+    fixed_width_cpuid_row_scanner(" :", "-"),
+]
+
+def sniff_cpuid_row(line):
+    """try every dialect on `line`, returning `(scanner, row)` for the first that
+    reads it, or `(None, None)`."""
+    if not line.startswith("CPUID "):
+        return (None, None)
+    for scanner in cpuid_row_scanners:
+        row = scanner(line)
+        if row is not None:
+            return (scanner, row)
+    return (None, None)
+
+# MSR rows are `MSR 0000001B: 00000000-FEE00900`, sometimes with the value in
+# four groups of four digits instead and usually with some bracketed notes on
+# the end, which are AIDA's own decoding of the value.
+msr_row_re = re.compile(
+    "MSR ([0-9A-F]{8}) ?: ?((?:[0-9A-F]{4}[- ]?){3}[0-9A-F]{4})(?: |$)")
+
+def scan_msr_row(line):
+    """`(msr, value)` for an MSR row, or None if `line` isn't one."""
+    # the usual `MSR 0000001B: 00000000-FEE00900` is quicker sliced apart.
+    if line[12:14] == ": " and line[22:23] == "-" and \
+            (len(line) == 31 or line[31] == " "):
+        try:
+            return (int(line[4:12], 16), int(line[14:22] + line[23:31], 16))
+        except ValueError:
+            pass
+    msr_info = msr_row_re.match(line)
+    if not msr_info:
+        return None
+    value = msr_info.group(2).replace("-", "").replace(" ", "")
+    return (int(msr_info.group(1), 16), int(value, 16))
+
+# MSRs that count or measure something as it happens, rather than describe the
+# processor. every logical cpu reads something different every time, so keeping
+# them would cost a row per thread per dump for nothing.
+VOLATILE_MSRS = set([
+    0x00000010, # IA32_TIME_STAMP_COUNTER
+    0x000000e7, # IA32_MPERF
+    0x000000e8, # IA32_APERF
+    0x00000198, # IA32_PERF_STATUS
+    0x0000019c, # IA32_THERM_STATUS
+    0x000001b1, # IA32_PACKAGE_THERM_STATUS
+    0x00000611, # MSR_PKG_ENERGY_STATUS
+    0x00000619, # MSR_DRAM_ENERGY_STATUS
+    0x00000639, # MSR_PP0_ENERGY_STATUS
+    0x00000641, # MSR_PP1_ENERGY_STATUS
+    0xc00000e7, # MPerfReadOnly
+    0xc00000e8, # APerfReadOnly
+    0xc0010063, # P-state Status
+    0xc0010293, # Hardware P-state Status
+    0xc001029a, # Core Energy Status
+    0xc001029b, # Package Energy Status
+])
+
+# where a logical cpu is, by AIDA's `allcpu:` lines.
+CoreLocation = collections.namedtuple("CoreLocation", "package core thread")
+
+class AIDAInfo:
+    def msr(self, index):
+        """the value of MSR `index` as read by the lowest-numbered logical cpu
+        that read it, or None if it wasn't read."""
+        readings = self.msrs.get(index)
+        if not readings:
+            return None
+        return min(readings.items(), key=lambda reading: min(reading[1]))[0]
+
+    def core_type_msrs(self, core_type):
+        """`self.msrs`, as read by just the logical cpus of `core_type`."""
+        cpus = set(core_type.cpus)
+        msrs = {}
+        for (index, readings) in self.msrs.items():
+            for (value, value_cpus) in readings.items():
+                value_cpus = [cpu for cpu in value_cpus if cpu in cpus]
+                if value_cpus:
+                    msrs.setdefault(index, {})[value] = value_cpus
+        return msrs
+
+    def feature(self, name):
+        return self.features.get(name)
 
     def add_feature(self, feat_info):
-        self.parsed_features.append(feat_info)
+        # a feature defined more than once is present if any definition says
+        # so, with the largest value any of them found.
+        existing = self.features.get(feat_info.shortname)
+        if existing is not None and existing.present and \
+                (not feat_info.present or feat_info.value <= existing.value):
+            return
+        self.features[feat_info.shortname] = feat_info
 
     def proc_name(self):
         family = self.feature("FamilyID").value
@@ -730,15 +1388,35 @@ class AIDAInfo:
 
         return False
 
-    def __init__(self, db, text):
-        global FEATURES
+    def __init__(self, db, text, source=None):
+        """parse an AIDA64 CPUID dump. `text` can be any iterable of lines, like
+        an open file; it's read only as far as the last section we care about,
+        so the rest of a large dump is never read at all."""
         state = ParseState.HEADER
+        # where `text` came from, only used to describe parse errors.
+        self.source = source
         self.name = None
         self.version = {}
         self.aida_cpuid = {}
         self.motherboard = {}
         self.cpuid = {}
-        self.parsed_features = []
+        # `{logical cpu: CoreLocation}`, from `allcpu:` lines.
+        self.locations = {}
+        # `{msr: {value: [logical cpus that read it]}}`. most MSRs read the same
+        # on every cpu, so this is about as big as one cpu's worth. see also
+        # `VOLATILE_MSRS`.
+        self.msrs = {}
+        # the logical cpus MSRs were read from at all, which isn't always all
+        # of them.
+        self.msr_cpus = set()
+        msr_cpunum = None
+        self.features = {}
+
+        # each logical cpu's CPUID table is filed under its `CoreType` as soon
+        # as its block ends, and shares the table of the first cpu that read
+        # the same. so a 256-thread dump holds a handful of tables, not 256.
+        core_types = CoreTypeSet()
+        cpuid_cpunum = None
 
         # some CPUID files have no headers before cpuid blocks at all.
         # so we'll just have to guess the current CPU number based on how many
@@ -753,6 +1431,10 @@ class AIDAInfo:
         self.guessed_cpuid_subleaf_nr = 0
         self.guessing_cpuid_subleaf_nr = None
 
+        # the scanner for whichever dialect of CPUID rows this file has, once
+        # we've seen one. see `sniff_cpuid_row`.
+        cpuid_row_scanner = None
+
         # TODO: header checks below should really be their own function, and
         # files should be presumed headerless until shown otherwise - if header
         # checks were extracted out this would be an easy check when it returns.
@@ -789,6 +1471,23 @@ class AIDAInfo:
             else:
                 self.first_data_line = False
 
+            # anything in an MSR block that isn't an MSR row is skipped without
+            # looking any closer than it takes to tell it isn't the next
+            # section's header.
+            if state == ParseState.MSRS:
+                if line.startswith("MSR ") and \
+                        not line.startswith("MSR Registers"):
+                    row = scan_msr_row(line)
+                    if row is not None and row[0] not in VOLATILE_MSRS:
+                        cpus = self.msrs.setdefault(row[0], {}) \
+                            .setdefault(row[1], [])
+                        if not cpus or cpus[-1] != msr_cpunum:
+                            cpus.append(msr_cpunum)
+                    continue
+                if not match_section_header(line):
+                    continue
+                state = ParseState.HEADER
+
             # some files have no header and open directly into CPUID info.
             # ... some of these are clearly many-cpu parts
             # (GenuineIntel0050670_KnightsLanding_CPUID.txt for example), so i'm
@@ -801,19 +1500,20 @@ class AIDAInfo:
                 elif self.headerless:
                     if not self.guessing_cpu_nr:
                         raise Exception("""duplicate CPUID 00000000 in \
-                            {}?""".format(sys.argv[1]))
+                            {}?""".format(self.source))
                     self.guessed_cpu_nr += 1
 
                 if self.headerless:
                     state = ParseState.CPUID
 
-                    self.cpuid[self.guessed_cpu_nr] = {}
-                    cpuid_buf = self.cpuid[self.guessed_cpu_nr]
-                    cpuid_buf["location"] = {
-                        "package": int(0),
-                        "core": int(self.guessed_cpu_nr),
-                        "thread": int(0)
-                    }
+                    if cpuid_cpunum is not None:
+                        self.cpuid[cpuid_cpunum] = core_types.intern(
+                            cpuid_cpunum, cpuid_buf)
+                    cpuid_cpunum = self.guessed_cpu_nr
+                    self.cpuid[cpuid_cpunum] = CPUIDTable()
+                    cpuid_buf = self.cpuid[cpuid_cpunum]
+                    self.locations[cpuid_cpunum] = CoreLocation(
+                        0, self.guessed_cpu_nr, 0)
 
             parsed = False
 
@@ -831,39 +1531,28 @@ class AIDAInfo:
             # data, AIDA reports an empty string for value, leading to a line
             # like `{label}   : `. so trim that off when reading values.
             if state == ParseState.VERSION:
-                for wanted_prefix, desc in version_lines.items():
-                    if line.startswith(wanted_prefix):
-                        self.version[desc] = line[len(wanted_prefix) + 1:]
-                        parsed = True
-                        break
+                label = match_label(version_labels, line)
+                if label:
+                    self.version[label[0]] = label[1]
+                    parsed = True
             elif state == ParseState.AIDA_CPUID:
-                for wanted_prefix, desc in aida_cpu_lines.items():
-                    if line.startswith(wanted_prefix):
-                        self.aida_cpuid[desc] = line[len(wanted_prefix) + 1:]
-                        parsed = True
-                        break
+                label = match_label(aida_cpu_labels, line)
+                if label:
+                    self.aida_cpuid[label[0]] = label[1]
+                    parsed = True
             elif state == ParseState.MOTHERBOARD:
-                for wanted_prefix, desc in motherboard_lines.items():
-                    if line.startswith(wanted_prefix):
-                        self.motherboard[desc] = line[len(wanted_prefix) + 1:]
-                        parsed = True
-                        break
-            elif state == ParseState.MSRS:
-                # TODO: ignore MSR lines.. for now.
-                parsed = True
-                break
+                label = match_label(motherboard_labels, line)
+                if label:
+                    self.motherboard[label[0]] = label[1]
+                    parsed = True
             elif state == ParseState.CPUID:
                 if line.startswith("allcpu: "):
-                    core_location = re.match(
-                        "allcpu: Package (\d+) / Core (\d+) / Thread (\d+): (.*)",
-                        line
-                    )
+                    core_location = core_location_re.match(line)
                     if core_location:
-                        cpuid_buf["location"] = {
-                            "package": int(core_location.group(1)),
-                            "core": int(core_location.group(2)),
-                            "thread": int(core_location.group(3))
-                        }
+                        self.locations[cpuid_cpunum] = CoreLocation(
+                            int(core_location.group(1)),
+                            int(core_location.group(2)),
+                            int(core_location.group(3)))
                         parsed = True
                     elif line == "allcpu: Valid":
                         if self.guessing_cpu_nr:
@@ -873,11 +1562,8 @@ class AIDAInfo:
                             # be a single cpu?
                             guessed_nr = 0
 
-                        cpuid_buf["location"] = {
-                            "package": 0,
-                            "core": guessed_nr,
-                            "thread": 0
-                        }
+                        self.locations[cpuid_cpunum] = CoreLocation(
+                            0, guessed_nr, 0)
                         parsed = True
                     elif line == "allcpu: Valid, Virtual":
                         # this one's annoying. for example,
@@ -899,55 +1585,23 @@ class AIDAInfo:
                             # be a single cpu?
                             guessed_nr = 0
 
-                        cpuid_buf["location"] = {
-                            "package": 0,
-                            "core": guessed_nr,
-                            "thread": 1
-                        }
+                        self.locations[cpuid_cpunum] = CoreLocation(
+                            0, guessed_nr, 1)
                         parsed = True
                     else:
                         raise Exception("bad allcpu line: {}".format(line))
                 else:
-                    # it's a line like `CPUID [0-9A-F]{8}: {regs}`?
-                    pat = """CPUID ([0-9A-F]{8}): ([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})( .*)?"""
-
-                    # some AMD summaries use space separators instead of hypen?
-                    amd_quirk_pat = """CPUID ([0-9A-F]{8}): ([0-9A-F]{8}) ([0-9A-F]{8}) ([0-9A-F]{8}) ([0-9A-F]{8})( .*)?"""
-
-                    # `AuthenticAMD0500F20_K14_Bobcat_CPUID.txt` has the colon
-                    # in a weird spot.
-                    bobcat_quirk_pat = """CPUID ([0-9A-F]{8}) :([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})( .*)?"""
-
-                    # or otherwise, maybe it's `CPUID  \t{regs}`. some older
-                    # Intel CPUID readings were like that.
-                    altpat = """CPUID ([0-9A-F]{8})\s+([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})-([0-9A-F]{8})( .*)?"""
-                    leaf_info = re.match(pat, line)
-                    if not leaf_info:
-                        leaf_info = re.match(altpat, line)
-                    if not leaf_info:
-                        leaf_info = re.match(amd_quirk_pat, line)
-                    if not leaf_info:
-                        leaf_info = re.match(bobcat_quirk_pat, line)
-                    if leaf_info:
-                        subleaf = None
-                        try:
-                            misc_info = leaf_info.group(6)
-                            infos = re.findall(" \[[^]]+\]", misc_info)
-                            for info in infos:
-                                sl = re.match(" \[SL ([0-9A-F]+)\]", info)
-                                if sl:
-                                    subleaf = int(sl.group(1), 16)
-                        except:
-                            # `group(6)` raised an exception because there's no
-                            # group. that's fine, just no subleaf.
-                            pass
-                        leaf = int(leaf_info.group(1), 16)
-                        leaf_record = {
-                            "eax": int(leaf_info.group(2), 16),
-                            "ebx": int(leaf_info.group(3), 16),
-                            "ecx": int(leaf_info.group(4), 16),
-                            "edx": int(leaf_info.group(5), 16)
-                        }
+                    # it's a line like `CPUID [0-9A-F]{8}: {regs}`? there are
+                    # a few dialects of these, see `cpuid_row_scanners`.
+                    row = None
+                    if cpuid_row_scanner:
+                        row = cpuid_row_scanner(line)
+                    if row is None:
+                        (scanner, row) = sniff_cpuid_row(line)
+                        if row is not None:
+                            cpuid_row_scanner = scanner
+                    if row is not None:
+                        (leaf, subleaf, eax, ebx, ecx, edx) = row
                         if subleaf is not None:
                             if self.guessing_cpuid_subleaf_nr == None:
                                 # we have suffixes like `[ SL 01 ]` telling us
@@ -963,35 +1617,33 @@ class AIDAInfo:
                                 # wrong. raise an error, though we don't
                                 # remember which leaf had duplicate entries.
                                 raise Exception("""duplicate cpuid leaves in \
-                                    {}""".format(sys.argv[3]))
-
-                            if leaf not in cpuid_buf:
-                                cpuid_buf[leaf] = {}
-                            else:
-                                if subleaf in cpuid_buf[leaf]:
-                                    allow_conflict = False
-
-                                    # what the hell, right?
-                                    # `AuthenticAMD0630F01_K15_Berlin_00_CPUID.txt`
-                                    # does this. one subleaf is duplicated on
-                                    # each core, and the duplicate record
-                                    # matches the previous entry. so just allow
-                                    # it. whyyyyyyy
-                                    if leaf == 0xd and subleaf == 0x3e and \
-                                        cpuid_buf[leaf][subleaf] == leaf_record:
-                                            allow_conflict = True
-
-                                    if not allow_conflict:
-                                        # if there is a conflict and we have
-                                        # reason to believe there is a specific
-                                        # subleaf number without guessing, just
-                                        # bail out.
-                                        # this is probably bad data.
-                                        raise Exception(
-                                            """duplicate cpuid subleaf: \
-                                            {}/{} {}""".format(leaf, subleaf,
-                                                sys.argv[3]))
-                            cpuid_buf[leaf][subleaf] = leaf_record
+                                    {}""".format(self.source))
+
+                            if cpuid_buf.row(leaf, subleaf) is not None:
+                                allow_conflict = False
+
+                                # what the hell, right?
+                                # `AuthenticAMD0630F01_K15_Berlin_00_CPUID.txt`
+                                # does this. one subleaf is duplicated on
+                                # each core, and the duplicate record
+                                # matches the previous entry. so just allow
+                                # it. whyyyyyyy
+                                if leaf == 0xd and subleaf == 0x3e and \
+                                    cpuid_buf.row(leaf, subleaf) == \
+                                        (eax, ebx, ecx, edx):
+                                        allow_conflict = True
+
+                                if not allow_conflict:
+                                    # if there is a conflict and we have
+                                    # reason to believe there is a specific
+                                    # subleaf number without guessing, just
+                                    # bail out.
+                                    # this is probably bad data.
+                                    raise Exception(
+                                        """duplicate cpuid subleaf: \
+                                        {}/{} {}""".format(leaf, subleaf,
+                                            self.source))
+                            cpuid_buf.add(leaf, subleaf, eax, ebx, ecx, edx)
                         else:
                             if leaf in cpuid_buf:
                                 # if there is no suffix reporting subleaves,
@@ -1003,32 +1655,27 @@ class AIDAInfo:
                                 elif self.guessing_cpuid_subleaf_nr == False:
                                     raise Exception(
                                         "duplicate cpuid leaf: {} - {}".format(
-                                            sys.argv[3], leaf))
+                                            self.source, leaf))
 
                                 # ok, now for the fun. at this leaf we have
                                 # either a single entry we need to promote to a
-                                # subleaf table, or a subleaf table. if it's a
-                                # subleaf table it's keyed by integers,
-                                # otherwise it's keyed by eax/ebx/ecx/edx.
-                                if "eax" in cpuid_buf[leaf]:
-                                    # promote this to a subleaf table
-                                    subleaves = {}
-                                    subleaves[0] = cpuid_buf[leaf]
-                                    cpuid_buf[leaf] = subleaves
+                                # subleaf table, or a subleaf table already.
+                                if not cpuid_buf.has_subleaves(leaf):
+                                    cpuid_buf.promote(leaf)
                                     # this means that the leaf we're looking at
                                     # is presumed to be the first subleaf
                                     self.guessed_cpuid_subleaf_nr = 1
 
-                                cpuid_buf[leaf][
-                                    self.guessed_cpuid_subleaf_nr
-                                ] = leaf_record
+                                cpuid_buf.add(leaf,
+                                    self.guessed_cpuid_subleaf_nr,
+                                    eax, ebx, ecx, edx)
                                 self.guessed_cpuid_subleaf_nr += 1
                             else:
-                                cpuid_buf[leaf] = leaf_record
+                                cpuid_buf.add(leaf, None, eax, ebx, ecx, edx)
                         parsed = True
                     else:
                         # might be the AIDA summary of cache info...
-                        if re.match("L\d .*Cache:", line):
+                        if cache_summary_re.match(line):
                             # yep. understood and don't care..
                             parsed = True
 
@@ -1038,79 +1685,109 @@ class AIDAInfo:
                 state = ParseState.HEADER
 
             if state == ParseState.HEADER:
-                for k, (next_name, next_state) in section_headers.items():
-                    if line == k:
-                        name = next_name
-                        state = next_state
-#                        print("state: {}".format(name))
-                        parsed = True
-                        break
-                    # TODO: some AIDA versions only read MSRs from one(?) core
-                    # and have one MSR Registers region as a result.
-                    # not sure what to do with that (yet)
-                    else:
-                        # header might be a regex, try that
-                        match = re.match(k, line)
-                        if match:
-                            # TODO: HACK: don't handle the remainder correctly
-                            # yet
-                            if k == "PerformanceFrequency =.*":
-                                parsed = True
-                                state = ParseState.DONE
-                                break
-                            # TODO: HACK: handle weird lines in Ryzen Z1 cpuid
-                            if line.startswith("Group: 0x00 Affinity mask: "):
-                                # see above about this pattern. guess CPU
-                                # numbers...
-                                self.inaccurate_core_number = True
-                                if not self.guessing_cpu_nr:
-                                    self.guessing_cpu_nr = True
-                                    self.guessed_cpu_nr = 0
-                                else:
-                                    self.guessed_cpu_nr += 1
-
-                                cpunum = self.guessed_cpu_nr
-                            else:
-                                # yep, that was it. currently the regexes all
-                                # have one \d+ group for the cpu/thread number
-                                # the header describes.
-                                cpunum = int(match.group(1))
-                                if self.first_data_line and cpunum == 1:
-                                    self.cpus_start_counting_from_1 = True
-
-                                if self.cpus_start_counting_from_1:
-                                    cpunum -= 1
-
-                            if re.match("CPUID Registers \(CPU .* Virtual\)",
-                                    line):
-                                self.inaccurate_core_number = True
-
-                            name = next_name
-                            state = next_state
-                            if next_state == ParseState.CPUID:
-                                self.cpuid[cpunum] = {}
-                                cpuid_buf = self.cpuid[cpunum]
-                            else:
-                                # non-cpuid state up next. probably MSRs.
-                                # HELP! handle MSRs!!!
-                                pass
-                            parsed = True
-                            break
+                # TODO: some AIDA versions only read MSRs from one(?) core
+                # and have one MSR Registers region as a result.
+                # not sure what to do with that (yet)
+                header = match_section_header(line)
+                if header:
+                    (name, next_state, cpu_field) = header
+                    parsed = True
+#                    print("state: {}".format(name))
+                    # TODO: HACK: don't handle the remainder correctly yet
+                    if next_state == ParseState.REMAINDER:
+                        state = ParseState.DONE
+                        continue
+
+                    state = next_state
+
+                    # TODO: HACK: handle weird lines in Ryzen Z1 cpuid
+                    if line.startswith("Group: 0x00 Affinity mask: "):
+                        # see above about this pattern. guess CPU
+                        # numbers...
+                        self.inaccurate_core_number = True
+                        if not self.guessing_cpu_nr:
+                            self.guessing_cpu_nr = True
+                            self.guessed_cpu_nr = 0
+                        else:
+                            self.guessed_cpu_nr += 1
+
+                        cpunum = self.guessed_cpu_nr
+                    elif cpu_field is not None:
+                        # the header describes a specific cpu/thread number.
+                        cpunum = int(cpu_field)
+                        if self.first_data_line and cpunum == 1:
+                            self.cpus_start_counting_from_1 = True
+
+                        if self.cpus_start_counting_from_1:
+                            cpunum -= 1
+
+                    if virtual_cpu_header_re.match(line):
+                        self.inaccurate_core_number = True
+
+                    if next_state == ParseState.CPUID:
+                        if cpuid_cpunum is not None:
+                            self.cpuid[cpuid_cpunum] = core_types.intern(
+                                cpuid_cpunum, cpuid_buf)
+                        cpuid_cpunum = cpunum
+                        self.cpuid[cpunum] = CPUIDTable()
+                        cpuid_buf = self.cpuid[cpunum]
+                    elif next_state == ParseState.MSRS:
+                        # a bare `MSR Registers` header is the only MSR block
+                        # in the file, presumably read on the first cpu.
+                        if cpu_field is not None:
+                            msr_cpunum = cpunum
+                        else:
+                            msr_cpunum = 0
+                        self.msr_cpus.add(msr_cpunum)
 
             if not parsed:
                 raise Exception("unhandled line: {}".format(line))
         # read ------[ Versions ]------
 
+        if cpuid_cpunum is not None:
+            self.cpuid[cpuid_cpunum] = core_types.intern(
+                cpuid_cpunum, cpuid_buf)
+        self.core_types = core_types.ordered()
+
         if 0 not in self.cpuid:
-            raise Exception("what's up in {}".format(sys.argv[1]))
+            raise Exception("what's up in {}".format(self.source))
+
+        self.derive(db)
+
+    @classmethod
+    def from_registers(cls, db, cpuid, msrs=None, source=None, batch=None):
+        """an `AIDAInfo` for CPUID tables (and MSRs, as in `AIDAInfo.msrs`)
+        that were already parsed once, like those stored in
+        `cpuid_table_registers` and `msr_values`. there's no AIDA text to go
+        with them, so only the register-derived parts are filled in. `batch`
+        is as for `derive`."""
+        info = cls.__new__(cls)
+        info.source = source
+        info.name = None
+        info.version = {}
+        info.aida_cpuid = {}
+        info.motherboard = {}
+        info.locations = {}
+        info.msrs = msrs or {}
+        info.msr_cpus = set(cpu for readings in info.msrs.values()
+            for cpus in readings.values() for cpu in cpus)
+        core_types = CoreTypeSet()
+        for cpunum in sorted(cpuid):
+            cpuid[cpunum] = core_types.intern(cpunum, cpuid[cpunum])
+        info.cpuid = cpuid
+        info.core_types = core_types.ordered()
+        info.derive(db, batch=batch)
+        return info
+
+    def derive(self, db, batch=None):
+        """(re)compute everything that comes from the CPUID tables and MSRs:
+        the brand string and all of `FEATURES`. `batch` is a `FeatureMatrix`
+        that already has the register bitfields, if there is one."""
         if 0x80000002 in self.cpuid[0]:
-            leaf1 = self.cpuid[0][0x80000002]
-            leaf2 = self.cpuid[0][0x80000003]
-            leaf3 = self.cpuid[0][0x80000004]
-            s = struct.pack("<IIIIIIIIIIII",
-                leaf1["eax"], leaf1["ebx"], leaf1["ecx"], leaf1["edx"], 
-                leaf2["eax"], leaf2["ebx"], leaf2["ecx"], leaf2["edx"], 
-                leaf3["eax"], leaf3["ebx"], leaf3["ecx"], leaf3["edx"]
+            leaf1 = self.cpuid[0].row(0x80000002)
+            leaf2 = self.cpuid[0].row(0x80000003)
+            leaf3 = self.cpuid[0].row(0x80000004)
+            s = struct.pack("<IIIIIIIIIIII", *(leaf1 + leaf2 + leaf3)
             ).decode("utf-8").rstrip("\x00").rstrip(" ")
 
             # there are two Van Gogh AMD APUs that have a newline at the end of
@@ -1121,229 +1798,2371 @@ class AIDAInfo:
         else:
             self.cpuid_name = None
 
-        self.parsed_features = []
-        for feature in FEATURES:
+        # `{shortname: ParsedFeature}`
+        self.features = {}
+        self.unresolved_features = []
+        FEATURE_PLAN.evaluate(self, db, batch=batch)
+
+    def resolve(self, db):
+        """parse whichever features were skipped for want of a database when
+        this was constructed with `db=None`."""
+        for feature in self.unresolved_features:
             parsed = feature.parse(self, db)
             if parsed:
-                self.parsed_features.append(parsed)
+                self.add_feature(parsed)
+        self.unresolved_features = []
+
+PRODUCT_INFO_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "product_info.sql")
+
+# the tables whose contents come from `product_info.sql`, in the order they're
+# filled in. `features` and `devices` are created there too, but are filled in
+# by ingest if at all.
+PRODUCT_INFO_TABLES = ["vendors", "families", "uarches", "family_model_info"]
+
+def product_info_version():
+    """names the contents of `product_info.sql`: a database seeded from a
+    different version needs `upgrade_product_info`."""
+    with open(PRODUCT_INFO_SQL, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+def product_info_template():
+    """the path of an empty database with `product_info.sql` in it, which new
+    databases are copied from. it's built the first time it's needed for each
+    version of `product_info.sql` and the schema, next to this script, or in
+    the temporary directory if that can't be written to."""
+    version = product_info_version()
+    name = "product_info.{}.{}.sqlite".format(version, SCHEMA_VERSION)
+    for directory in (os.path.dirname(PRODUCT_INFO_SQL), tempfile.gettempdir()):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+        try:
+            (fd, building) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        except OSError:
+            continue
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(building)
+            connection.executescript(open(PRODUCT_INFO_SQL, "r").read())
+            connection.executescript(INGEST_TABLES)
+            connection.executescript(INGEST_INDEXES)
+            connection.executescript("""
+                create table metadata (key TEXT PRIMARY KEY, value TEXT);
+                """)
+            connection.executemany("""insert into metadata (key, value)
+                values (?, ?)""", [("product_info", version),
+                    ("schema", str(SCHEMA_VERSION))])
+            connection.commit()
+            connection.close()
+            # built beside the final name and renamed into place, so another
+            # process never copies a half-built template. `mkstemp` makes it
+            # readable only by whoever built it, which in the temporary
+            # directory isn't necessarily whoever opens it next.
+            os.chmod(building, 0o644)
+            os.replace(building, path)
+        except BaseException:
+            os.unlink(building)
+            raise
+        return path
+    raise Exception("nowhere to build a product_info template")
 
 def init_db(dbpath):
+    """create `dbpath` as a copy of the `product_info_template`."""
+    template = sqlite3.connect(product_info_template())
     connection = sqlite3.connect("{}".format(dbpath))
-    connection.cursor().executescript(open("product_info.sql", "r").read())
+    template.backup(connection)
+    connection.close()
+    template.close()
+
+def upgrade_product_info(connection):
+    """bring the `PRODUCT_INFO_TABLES` of a database up to date with
+    `product_info.sql`, if it was seeded from a different version of it (or
+    from before versions were kept). cpus' `uarch` and `family`, and those
+    features, refer to rows of these tables by id, so they're moved to
+    whichever new rows have the same names. a uarch that's gone is NULL."""
+    version = product_info_version()
+    try:
+        current = connection.execute("""select value from metadata
+            where key='product_info'""").fetchone()
+    except sqlite3.OperationalError:
+        current = None
+    if current is not None and current[0] == version:
+        return False
 
-def add(dbpath, cpuid_filename):
+    connection.execute("attach database ? as seed", (product_info_template(),))
+    connection.execute("begin")
+
+    # uarches and families aren't quite unique by name (there are a few Coffee
+    # Lakes), so tell apart those that share a name by the order they're in.
+    for (table, query) in (
+        ("families", """select families.id,
+            row_number() over (partition by vendors.brandstring, families.name
+                order by families.id) as nth,
+            vendors.brandstring as vendor, families.name as name
+            from {0}.families join {0}.vendors
+                on vendors.id = families.vendor"""),
+        ("uarches", """select uarches.id,
+            row_number() over (partition by vendors.brandstring,
+                families.name, uarches.name order by uarches.id) as nth,
+            vendors.brandstring || '/' || families.name as vendor,
+            uarches.name as name
+            from {0}.uarches join {0}.families
+                on families.id = uarches.family
+            join {0}.vendors on vendors.id = families.vendor"""),
+    ):
+        connection.execute("drop table if exists temp.{}_moved".format(table))
+        connection.execute("""create temp table {}_moved as
+            select old.id as old, min(new.id) as new
+            from ({}) as old left join ({}) as new
+                on old.vendor = new.vendor and old.name is new.name and
+                    old.nth = new.nth
+            group by old.id""".format(
+                table, query.format("main"), query.format("seed")))
+
+    for table in PRODUCT_INFO_TABLES:
+        (create,) = connection.execute("""select sql from seed.sqlite_master
+            where type='table' and name=?""", (table,)).fetchone()
+        connection.execute("drop table if exists main.{}".format(table))
+        connection.execute(create)
+        connection.execute("insert into main.{0} select * from seed.{0}".format(
+            table))
+
+    tables = set(row[0] for row in connection.execute(
+        "select name from main.sqlite_master where type='table'"))
+    for (column, moved) in (("uarch", "uarches_moved"),
+            ("family", "families_moved")):
+        if "cpus" in tables:
+            connection.execute("""update cpus set {0} =
+                (select new from temp.{1} where old = cpus.{0})
+                where {0} is not NULL""".format(column, moved))
+        # `features` is UNIQUE by (name, value), so when ids shift, moving a
+        # value onto the next one's old id would collide with it. move them
+        # all out of the way to negative ids first, then back.
+        if "features" in tables:
+            connection.execute("""update features set value =
+                -(select new from temp.{} where old = features.value)
+                where name = ?""".format(moved), (column,))
+            connection.execute("""update features set value = -value
+                where name = ? and value < 0""", (column,))
+
+    connection.execute("""create table if not exists metadata (
+        key TEXT PRIMARY KEY, value TEXT)""")
+    connection.execute("""insert or replace into metadata (key, value)
+        values ('product_info', ?)""", (version,))
+    connection.commit()
+    connection.execute("detach database seed")
+    return True
+
+# `dataset` would create these on first insert, but doing that inside an ingest
+# transaction while parser processes are running earns a warning about schema
+# changes racing other threads. so, create them up front, exactly as `dataset`
+# would have.
+INGEST_TABLES = """
+-- foreign keys are declared for documentation and `pragma foreign_key_check`,
+-- but aren't enforced: `upgrade_product_info` replaces the tables `cpus` points
+-- into wholesale.
+create table if not exists cpus (
+    id INTEGER NOT NULL,
+    name TEXT,
+    cpuid_fms BIGINT,
+    family INTEGER REFERENCES families (id),
+    uarch INTEGER REFERENCES uarches (id),
+    source TEXT,
+    "virtual" BOOLEAN,
+    fingerprint TEXT,
+    feature_mask BLOB,
+    PRIMARY KEY (id)
+);
+-- which bit of `cpus.feature_mask` each boolean feature is. a mask is the
+-- little-endian bytes of an integer with a bit set for each boolean feature the
+-- cpu has as 1, so "has all of these and none of those" is a couple of ANDs.
+-- bits are handed out as features are first seen and never reassigned, so
+-- masks stay comparable as `FEATURES` changes.
+create table if not exists feature_bits (
+    bit INTEGER NOT NULL,
+    name TEXT NOT NULL UNIQUE,
+    PRIMARY KEY (bit)
+);
+-- every distinct feature value any cpu has, like `AVX2 = 1` or `uarch = 118`.
+create table if not exists features (
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER,
+    PRIMARY KEY (id),
+    UNIQUE (name, value)
+);
+-- which cpus have which feature values. keyed by feature first, since that's
+-- what queries look up by; `cpu_features_cpu` covers the other way.
+create table if not exists cpu_features (
+    cpu INTEGER NOT NULL REFERENCES cpus (id),
+    feature INTEGER NOT NULL REFERENCES features (id),
+    PRIMARY KEY (feature, cpu)
+) WITHOUT ROWID;
+-- `cpu_features` summed up: how many of the cpus of each family and uarch have
+-- each feature value, and how many cpus of that family and uarch there are in
+-- all. coverage questions ("which families have some cpus with AVX2") read
+-- this, which is the same size however many cpus there are. it's kept up to
+-- date as cpus are added and removed (see `CoverageDelta`), and rebuilt
+-- whenever cpus change wholesale. `uarch` is 0 for cpus without a known uarch;
+-- cpus without a family aren't counted. rows only exist for features at least
+-- one cpu has, and every row of a family and uarch has the same `cpus_total`.
+create table if not exists coverage (
+    family INTEGER NOT NULL REFERENCES families (id),
+    uarch INTEGER NOT NULL,
+    feature INTEGER NOT NULL REFERENCES features (id),
+    cpus_with INTEGER NOT NULL,
+    cpus_total INTEGER NOT NULL,
+    PRIMARY KEY (family, uarch, feature)
+) WITHOUT ROWID;
+-- raw CPUID tables, so features can be re-evaluated (see `rederive`) without
+-- reparsing any text. each distinct table is stored once, however many logical
+-- cpus or dumps read it: `fingerprint` is `cpuid_fingerprint`, which ignores
+-- APIC IDs, so the IDs in a stored table are whichever reading stored it first.
+-- `subleaf` is NULL for leaves without subleaves.
+create table if not exists cpuid_tables (
+    id INTEGER NOT NULL,
+    fingerprint TEXT UNIQUE,
+    PRIMARY KEY (id)
+);
+create table if not exists cpuid_table_registers (
+    id INTEGER NOT NULL,
+    cpuid_table BIGINT,
+    leaf BIGINT,
+    subleaf BIGINT,
+    eax BIGINT,
+    ebx BIGINT,
+    ecx BIGINT,
+    edx BIGINT,
+    PRIMARY KEY (id)
+);
+create index if not exists cpuid_table_registers_table on
+    cpuid_table_registers (cpuid_table);
+-- the kinds of core in each cpu (see `CoreType`) and which logical cpus are
+-- which, like `0-15` or `16-23`. core type 0 is always the one logical cpu 0
+-- is, and its features are the cpu's `cpu_features`.
+create table if not exists cpu_core_types (
+    id INTEGER NOT NULL,
+    cpu BIGINT,
+    core_type BIGINT,
+    cpuid_table BIGINT,
+    logical_cpus TEXT,
+    PRIMARY KEY (id)
+);
+create index if not exists cpu_core_types_cpu on cpu_core_types (cpu);
+create index if not exists cpu_core_types_table on cpu_core_types (cpuid_table);
+-- features of each core type other than 0, for cpus that have more than one.
+create table if not exists core_type_features (
+    id INTEGER NOT NULL,
+    cpu BIGINT,
+    core_type BIGINT,
+    feature BIGINT,
+    PRIMARY KEY (id)
+);
+create index if not exists core_type_features_cpu on core_type_features (cpu);
+-- MSR values, one row per distinct value of an MSR among a core type's logical
+-- cpus. `logical_cpus` is NULL if every cpu of the core type that had MSRs
+-- read at all read that value, which is most of the time, so this is usually
+-- one row per MSR per core type rather than per thread. `value` is the MSR's
+-- 64 bits as a signed integer, since that's what sqlite has; see `msr_to_db`.
+create table if not exists msr_values (
+    id INTEGER NOT NULL,
+    cpu BIGINT,
+    core_type BIGINT,
+    msr BIGINT,
+    value BIGINT,
+    logical_cpus TEXT,
+    PRIMARY KEY (id)
+);
+create index if not exists msr_values_cpu on msr_values (cpu);
+-- every dump that's been ingested, and which cpu it was recorded as (or found
+-- to be a duplicate of). `--incremental` uses this to skip unchanged dumps.
+create table if not exists sources (
+    id INTEGER NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    size BIGINT,
+    mtime_ns BIGINT,
+    sha256 TEXT,
+    cpu BIGINT,
+    PRIMARY KEY (id)
+);
+"""
+
+# columns added to ingest tables since they were first created, which databases
+# from before then need added.
+INGEST_COLUMNS = {
+    "cpus": [("fingerprint", "TEXT"), ("feature_mask", "BLOB")],
+}
+
+INGEST_INDEXES = """
+create index if not exists cpus_fingerprint on cpus (fingerprint);
+create index if not exists cpus_name on cpus (name);
+create index if not exists cpus_family on cpus (family);
+create index if not exists cpus_uarch on cpus (uarch);
+create index if not exists cpu_features_cpu on cpu_features (cpu);
+-- `sources.path` is UNIQUE already, but `dataset` can't see that index and
+-- would create its own on the first upsert, mid-transaction.
+create index if not exists sources_path on sources (path);
+"""
+
+# bumped whenever tables in `INGEST_TABLES` change in a way `create table if not
+# exists` and `INGEST_COLUMNS` can't bring an existing database up to.
+#
+# 1: `features` is UNIQUE by (name, value), `cpu_features` is keyed by
+#    (feature, cpu) instead of a rowid, and foreign keys are declared.
+SCHEMA_VERSION = 1
+
+# the tables `upgrade_schema` rebuilds, and the columns it copies from the old
+# ones. `features` and `cpu_features` are copied specially, to merge duplicate
+# features.
+REBUILT_TABLES = {
+    "cpus": ["id", "name", "cpuid_fms", "family", "uarch", "source",
+        '"virtual"', "fingerprint", "feature_mask"],
+    "features": None,
+    "cpu_features": None,
+}
+
+def sql_statements(script):
+    """split a script of SQL statements into statements, so they can be run in
+    one transaction (which `executescript` can't do)."""
+    statement = ""
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+
+def schema_version(connection):
+    try:
+        row = connection.execute("""select value from metadata
+            where key='schema'""").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row is not None else 0
+
+def upgrade_schema(connection):
+    """rebuild the `REBUILT_TABLES` of a database from before `SCHEMA_VERSION`
+    with their current definitions. features that were recorded twice under
+    different ids are merged into the first."""
+    if schema_version(connection) >= SCHEMA_VERSION:
+        return False
+
+    # renaming a table would otherwise rewrite other tables' references to it
+    # to follow it.
+    connection.execute("pragma legacy_alter_table=ON")
+    connection.execute("begin")
+    present = set(row[0] for row in connection.execute(
+        "select name from sqlite_master where type='table'"))
+    for table in REBUILT_TABLES:
+        if table in present:
+            connection.execute("alter table {0} rename to {0}_old".format(table))
+    for statement in sql_statements(INGEST_TABLES):
+        connection.execute(statement)
+
+    if "cpus" in present:
+        columns = ", ".join(REBUILT_TABLES["cpus"])
+        connection.execute("""insert into cpus ({0})
+            select {0} from cpus_old""".format(columns))
+
+    if "features" in present:
+        connection.execute("""create temp table features_moved as
+            select features_old.id as old, kept.id as new from features_old
+            join (select min(id) as id, name, value from features_old
+                group by name, value) as kept
+            on kept.name = features_old.name and
+                kept.value is features_old.value""")
+        connection.execute("""insert into features (id, name, value)
+            select id, name, value from features_old
+            where id in (select new from temp.features_moved)""")
+        if "cpu_features" in present:
+            connection.execute("""insert or ignore into cpu_features
+                (cpu, feature)
+                select cpu, coalesce(new, feature) from cpu_features_old
+                left join temp.features_moved on old = feature
+                where cpu is not NULL and feature is not NULL""")
+        if "core_type_features" in present:
+            connection.execute("""update core_type_features set feature =
+                (select new from temp.features_moved where old = feature)
+                where feature in (select old from temp.features_moved
+                    where old != new)""")
+        connection.execute("drop table temp.features_moved")
+
+    for table in REBUILT_TABLES:
+        if table in present:
+            connection.execute("drop table {}_old".format(table))
+
+    connection.execute("""create table if not exists metadata (
+        key TEXT PRIMARY KEY, value TEXT)""")
+    connection.execute("""insert or replace into metadata (key, value)
+        values ('schema', ?)""", (str(SCHEMA_VERSION),))
+    connection.commit()
+    connection.execute("pragma legacy_alter_table=OFF")
+    return True
+
+# how long a connection waits on another's lock before it gives up with
+# `database is locked`. in WAL mode readers never wait on the writer, but the
+# writer can still wait on a checkpoint or another writer, and a reader on a
+# schema upgrade.
+BUSY_TIMEOUT = 30.0
+
+# run on every connection `open_db` makes. `synchronous=NORMAL` is still
+# durable against crashes in WAL mode, and saves an fsync per commit.
+WRITE_PRAGMAS = [
+    "pragma busy_timeout={}".format(int(BUSY_TIMEOUT * 1000)),
+    "pragma synchronous=NORMAL",
+]
+
+# the read-only query profile `open_query_db` uses: the database file is
+# mapped rather than read(2) through sqlite's page cache, the page cache is
+# bigger for the pages that aren't, and `query_only` makes sure nothing a
+# query runs can write.
+QUERY_PRAGMAS = [
+    "pragma busy_timeout={}".format(int(BUSY_TIMEOUT * 1000)),
+    "pragma query_only=1",
+    "pragma mmap_size={}".format(256 << 20),
+    # negative sizes are in KiB rather than pages.
+    "pragma cache_size=-{}".format(64 << 10),
+    "pragma temp_store=MEMORY",
+]
+
+def feature_mask_bytes(mask):
+    """an integer `feature_mask` as what's stored in `cpus`."""
+    return mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+
+def assign_feature_bits(connection):
+    """give each boolean feature in `FEATURES` without a `feature_bits` row the
+    next bit after the highest one handed out so far."""
+    known = set(row[0] for row in
+        connection.execute("select name from feature_bits"))
+    (top,) = connection.execute(
+        "select coalesce(max(bit), -1) from feature_bits").fetchone()
+    new = [name for name in FEATURE_PLAN.bool_features if name not in known]
+    connection.executemany("insert into feature_bits (bit, name) values (?, ?)",
+        enumerate(new, top + 1))
+    connection.commit()
+
+def fill_feature_masks(connection):
+    """work out `feature_mask` for cpus that don't have one from their
+    `cpu_features`, which for databases from before masks is every cpu. this
+    doesn't need stored registers, so it covers cpus `rederive` can't."""
+    masks = dict((row[0], 0) for row in connection.execute(
+        "select id from cpus where feature_mask is NULL"))
+    if not masks:
+        return
+    for (cpu, bit) in connection.execute("""select cpus.id, feature_bits.bit
+            from cpus join cpu_features on cpu_features.cpu = cpus.id
+            join features on features.id = cpu_features.feature
+            join feature_bits on feature_bits.name = features.name
+            where cpus.feature_mask is NULL and features.value = 1"""):
+        masks[cpu] |= 1 << bit
+    connection.executemany("update cpus set feature_mask=? where id=?",
+        ((feature_mask_bytes(mask), cpu) for (cpu, mask) in masks.items()))
+    connection.commit()
+
+COVERAGE_REBUILD = """
+delete from coverage;
+insert into coverage (family, uarch, feature, cpus_with, cpus_total)
+    select cpus.family, ifnull(cpus.uarch, 0), cpu_features.feature, count(*),
+        totals.cpus
+    from cpu_features join cpus on cpus.id = cpu_features.cpu
+    join (select family, ifnull(uarch, 0) as uarch, count(*) as cpus
+            from cpus where family is not NULL group by 1, 2) as totals
+        on totals.family = cpus.family and
+            totals.uarch = ifnull(cpus.uarch, 0)
+    group by cpus.family, ifnull(cpus.uarch, 0), cpu_features.feature;
+"""
+
+def rebuild_coverage(query):
+    """recount `coverage` from scratch out of `cpu_features`. `query` runs a
+    statement: a sqlite3 connection's `execute`, or `db.query`."""
+    for statement in sql_statements(COVERAGE_REBUILD):
+        query(statement)
+
+class CoverageDelta:
+    """changes to `coverage` from cpus being added and removed, kept until
+    `apply` writes them all at once. cpus of the same family and uarch share
+    most of their features, so a batch of them is far fewer rows to write than
+    each cpu's features one by one."""
+    def __init__(self):
+        self.totals = collections.Counter()
+        self.counts = collections.Counter()
+
+    def count(self, family, uarch, feature_ids, delta):
+        """count a cpu of `family` and `uarch` with the `feature_ids`, with a
+        `delta` of 1, or take it back out, with -1."""
+        if family is None:
+            return
+        group = (family, uarch or 0)
+        self.totals[group] += delta
+        for feature in feature_ids:
+            self.counts[group + (feature,)] += delta
+
+    def merge(self, other):
+        """count the changes in another `CoverageDelta` too."""
+        self.totals.update(other.totals)
+        self.counts.update(other.counts)
+
+    def apply(self, db):
+        """write the changes counted so far to `db`'s `coverage`."""
+        execute = db.executable.execute
+        totals = [{"family": family, "uarch": uarch, "delta": delta}
+            for ((family, uarch), delta) in self.totals.items() if delta]
+        counts = [{
+            "family": family,
+            "uarch": uarch,
+            "feature": feature,
+            "delta": delta,
+            "total": self.totals[(family, uarch)],
+        } for ((family, uarch, feature), delta) in self.counts.items() if delta]
+        if totals:
+            execute(sqlalchemy.text("""update coverage
+                set cpus_total = cpus_total + :delta
+                where family = :family and uarch = :uarch"""), totals)
+        # a feature the family and uarch had no cpus with yet starts off with
+        # their total, which the update above has already brought up to date,
+        # or if they had no cpus at all, the cpus just added.
+        if counts:
+            execute(sqlalchemy.text("""insert into coverage
+                    (family, uarch, feature, cpus_with, cpus_total)
+                values (:family, :uarch, :feature, :delta, ifnull(
+                    (select max(cpus_total) from coverage
+                        where family = :family and uarch = :uarch), :total))
+                on conflict (family, uarch, feature)
+                    do update set cpus_with = cpus_with + excluded.cpus_with"""),
+                counts)
+        if any(row["delta"] < 0 for row in counts):
+            execute(sqlalchemy.text(
+                "delete from coverage where cpus_with <= 0"))
+        self.totals.clear()
+        self.counts.clear()
+
+def open_db(dbpath):
+    """open `dbpath` to write to, creating it or bringing its schema up to date
+    first. databases are put in WAL mode, so queries through `open_query_db`
+    carry on while an ingest is writing."""
     if not os.path.isfile(dbpath):
         init_db(dbpath)
 
-    text = open(cpuid_filename, "r").readlines()
-    db = dataset.connect("sqlite:///{}".format(dbpath))
+    connection = sqlite3.connect("{}".format(dbpath), timeout=BUSY_TIMEOUT)
+    # WAL is a property of the database file, so this sticks for every other
+    # connection, including read-only ones.
+    connection.execute("pragma journal_mode=WAL")
+    # `coverage` is counted from scratch for databases from before it, and
+    # whenever cpus' families, uarches or features are moved around below.
+    recount = connection.execute("""select count(*) from sqlite_master
+        where name = 'coverage'""").fetchone()[0] == 0
+    if upgrade_product_info(connection):
+        recount = True
+        print("updated {} to the current product_info.sql; `rederive` it to "
+            "apply any new family/model mappings".format(dbpath))
+    connection.cursor().executescript(INGEST_TABLES)
+    for (table, columns) in INGEST_COLUMNS.items():
+        present = set(row[1] for row in
+            connection.execute("pragma table_info({})".format(table)))
+        for (column, decl) in columns:
+            if column not in present:
+                connection.execute("alter table {} add column {} {}".format(
+                    table, column, decl))
+    if upgrade_schema(connection):
+        recount = True
+    connection.cursor().executescript(INGEST_INDEXES)
+    assign_feature_bits(connection)
+    fill_feature_masks(connection)
+    if recount:
+        rebuild_coverage(connection.execute)
+        connection.commit()
+    connection.close()
+
+    db = dataset.connect("sqlite:///{}".format(dbpath),
+        on_connect_statements=list(WRITE_PRAGMAS))
+    migrate_cpuid_registers(db)
+    return db
+
+def open_query_db(dbpath):
+    """open `dbpath` read-only with the `QUERY_PRAGMAS` profile, for queries
+    that may run while something else is ingesting into it. unlike `open_db`
+    this never creates or upgrades anything, so it's an error if `dbpath`
+    doesn't exist."""
+    url = "sqlite:///file:{}?mode=ro&uri=true".format(
+        urllib.parse.quote(os.path.abspath(dbpath)))
+    return dataset.connect(url, ensure_schema=False, sqlite_wal_mode=False,
+        on_connect_statements=list(QUERY_PRAGMAS))
+
+def migrate_cpuid_registers(db):
+    """databases from before core types kept a full copy of every logical cpu's
+    registers in `cpuid_registers`. fold those into `cpu_core_types` and drop
+    it. features of any extra core types found are left for `rederive`."""
+    if "cpuid_registers" not in db.tables:
+        return
+
+    cpus = {}
+    for row in db.query("""select cpu, logical_cpu, leaf, subleaf,
+            eax, ebx, ecx, edx from cpuid_registers"""):
+        cpuid = cpus.setdefault(row['cpu'], {})
+        if row['logical_cpu'] not in cpuid:
+            cpuid[row['logical_cpu']] = CPUIDTable()
+        add_register_row(cpuid[row['logical_cpu']], row)
+
+    db.begin()
+    hybrid = 0
+    for (cpu_id, cpuid) in cpus.items():
+        core_types = CoreTypeSet()
+        for cpunum in sorted(cpuid):
+            core_types.intern(cpunum, cpuid[cpunum])
+        core_types = core_types.ordered()
+        if len(core_types) > 1:
+            hybrid += 1
+        store_core_types(db, cpu_id, core_types)
+    db.query("drop table cpuid_registers")
+    db.commit()
+
+    if hybrid:
+        print("found {} cpus with more than one core type; run `rederive` to "
+            "evaluate their features".format(hybrid))
+
+# InstLatx64 names dumps like `GenuineIntel0090675_AlderLake_01_CPUID.txt`, or
+# `AuthenticAMD0040F12_K8_SantaRosa_CPUID_S8.txt` for a few odd ones.
+CPUID_FILE_PATTERN = "*_CPUID*.txt"
+
+# compressed single dumps, like `..._CPUID.txt.gz`, are opened with these.
+COMPRESSED_FILE_OPENERS = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
 
-    info = AIDAInfo(db, text)
+TAR_SUFFIXES = [".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2"]
+
+class CPUIDSource:
+    """a CPUID dump to ingest: either a file on disk (possibly compressed) or a
+    member of an archive. `name` is what's recorded as `cpus.source`."""
+    def __init__(self, name, path=None, data=None, size=None, mtime_ns=None):
+        self.name = name
+        self.path = path
+        # archive members are read out as they're walked past, since a
+        # compressed tarball can only be read front to back.
+        self.data = data
+        if path is not None:
+            st = os.stat(path)
+            size = st.st_size
+            mtime_ns = st.st_mtime_ns
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = None
+
+    def open(self):
+        """the dump as a text file."""
+        if self.data is not None:
+            return io.TextIOWrapper(io.BytesIO(self.data))
+        (_, ext) = os.path.splitext(self.path)
+        if ext in COMPRESSED_FILE_OPENERS:
+            return COMPRESSED_FILE_OPENERS[ext](self.path, "rt")
+        return open(self.path, "r")
+
+    def sha256(self):
+        """hex SHA-256 of the dump as stored (so, compressed if it's a `.gz`)."""
+        if self.digest is None:
+            if self.data is not None:
+                self.digest = hashlib.sha256(self.data).hexdigest()
+            else:
+                h = hashlib.sha256()
+                with open(self.path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+                self.digest = h.hexdigest()
+        return self.digest
+
+def cpuid_file_name_matches(filename, pattern):
+    # `..._CPUID.txt.gz` should match the same pattern as `..._CPUID.txt`.
+    (base, ext) = os.path.splitext(filename)
+    if ext in COMPRESSED_FILE_OPENERS:
+        filename = base
+    return fnmatch.fnmatch(os.path.basename(filename), pattern)
+
+def is_archive(path):
+    return path.endswith(".zip") or \
+        any(path.endswith(suffix) for suffix in TAR_SUFFIXES)
+
+def iter_archive(path, pattern):
+    """yield a `CPUIDSource` for each member of the archive at `path` whose name
+    matches `pattern`, without extracting anything to disk."""
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and \
+                        cpuid_file_name_matches(member.filename, pattern):
+                    yield CPUIDSource(
+                        "{}:{}".format(path, member.filename),
+                        data=archive.read(member),
+                        size=member.file_size,
+                        mtime_ns=int(time.mktime(
+                            member.date_time + (0, 0, -1))) * 10**9)
+        return
+
+    # stream mode, so members are decompressed once, in order.
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and \
+                    cpuid_file_name_matches(member.name, pattern):
+                yield CPUIDSource(
+                    "{}:{}".format(path, member.name),
+                    data=archive.extractfile(member).read(),
+                    size=member.size,
+                    mtime_ns=int(member.mtime) * 10**9)
+
+def iter_sources(paths, pattern=CPUID_FILE_PATTERN):
+    """expand a mix of files, archives, directories and globs into the CPUID
+    dumps to ingest. directories are walked recursively, and archives read
+    through, for files matching `pattern`. this is a generator so that archive
+    members are only held in memory while they're being ingested."""
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if cpuid_file_name_matches(filename, pattern):
+                        filepath = os.path.join(dirpath, filename)
+                        yield CPUIDSource(filepath, path=filepath)
+            continue
 
-    cpu_table = db['cpus']
+        if os.path.exists(path):
+            matches = [path]
+        else:
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                print("no files match {}".format(path))
 
-    cpu_features = db['cpu_features']
+        for match in matches:
+            if is_archive(match):
+                yield from iter_archive(match, pattern)
+            else:
+                yield CPUIDSource(match, path=match)
+
+def add_info(db, info, source, feature_ids=None, coverage_delta=None):
+    """record an already-parsed `AIDAInfo` in `db`. returns `(cpu_id, added)`,
+    where `added` is False if an identical processor was already present and
+    `cpu_id` is that processor. `feature_ids` is the `FeatureIds` for `db`, and
+    `coverage_delta` a `CoverageDelta` to count the cpu in, if the caller is
+    adding more than one cpu; otherwise `coverage` is updated right away."""
+    cpu_table = db['cpus']
 
-    if cpu_table.find_one(name=info.proc_name(),
-            virtual=info.suspected_virtual()):
+    # readings whose CPUID tables are identical, give or take APIC IDs, are the
+    # same processor in the same configuration - often the same dump uploaded
+    # more than once. they're all recorded as the first one.
+    fingerprint = processor_fingerprint(info.core_types)
+    existing = cpu_table.find_one(fingerprint=fingerprint)
+    if not existing:
+        # cpus from before fingerprints were recorded can only be matched up by
+        # name, as they used to be. `rederive` fills their fingerprints in if
+        # their registers were stored.
+        existing = cpu_table.find_one(name=info.proc_name(),
+            virtual=info.suspected_virtual(), fingerprint=None)
+    if existing:
 #        print("'{}' already exists?".format(info.proc_name()))
-        sys.exit(0)
+        return (existing['id'], False)
+
+    feature_ids = feature_ids or FeatureIds(db)
 
-    fam_id = info.feature("family").value
+    # a processor that isn't in `product_info.sql` is recorded without a
+    # family or uarch, as `rederive` does, rather than not at all.
+    family = info.feature("family")
+    fam_id = family.value if family else None
 
-    uarch_id = info.feature("uarch").value
+    uarch = info.feature("uarch")
+    uarch_id = uarch.value if uarch else None
 
-    first_cpu_info = info.cpuid[0]
-    leaf_0h = first_cpu_info[0]
+    leaf_0h = info.cpuid[0].row(0)
     cpu_id = cpu_table.insert({
         "name": info.proc_name(),
-        "cpuid_fms": leaf_0h['eax'],
+        "cpuid_fms": leaf_0h[0],
         "family": fam_id,
         "uarch": uarch_id,
-        "source": cpuid_filename,
+        "source": source,
         "virtual": info.suspected_virtual(),
+        "fingerprint": fingerprint,
+        "feature_mask": feature_ids.mask(present_features(info)),
     })
 
-    for feat in info.parsed_features:
-        if feat.present:
-            db_feat = db['features'].find_one(
-                    name=feat.shortname, value=feat.value)
-            if not db_feat:
-                feat_id = db['features'].insert({
-                    "name": feat.shortname,
-                    "value": feat.value,
-                })
+    delta = coverage_delta or CoverageDelta()
+    delta.count(fam_id, uarch_id,
+        store_features(db, feature_ids, cpu_id, info, source), 1)
+    if coverage_delta is None:
+        delta.apply(db)
+    store_core_types(db, cpu_id, info.core_types)
+    store_msrs(db, cpu_id, info)
+
+    return (cpu_id, True)
+
+def insert_rows(db, table, rows):
+    """insert `rows`, dicts that all have the same keys, into `table` with one
+    executemany. `dataset`'s `insert_many` checks every row's columns against
+    the table first, which is most of the cost of writing a cpu."""
+    if not rows:
+        return
+    columns = list(rows[0])
+    db.executable.execute(sqlalchemy.text("""insert into {} ({})
+        values ({})""".format(table, ", ".join(columns),
+            ", ".join(":" + column for column in columns))), rows)
+
+class FeatureIds:
+    """`features` as `{(name, value): id}`, read once so a cpu's feature ids are
+    found without a query per feature. features that aren't in `features` yet
+    are added all at once by `ids_of`. `feature_bits` is read too, for
+    `mask`."""
+    # how many features one `INSERT ... RETURNING` adds, well within sqlite's
+    # limit on bound parameters.
+    INSERT_BATCH = 500
+
+    def __init__(self, db):
+        self.ids = {}
+        for row in db.query("select id, name, value from features"):
+            self.ids[(row['name'], row['value'])] = row['id']
+        self.bits = dict((row['name'], row['bit']) for row in
+            db.query("select bit, name from feature_bits"))
+
+    def mask(self, keys):
+        """the `cpus.feature_mask` of a cpu whose features are the
+        `(name, value)`s in `keys`."""
+        mask = 0
+        for (name, value) in keys:
+            bit = self.bits.get(name)
+            if bit is not None and value == 1:
+                mask |= 1 << bit
+        return feature_mask_bytes(mask)
+
+    def ids_of(self, db, keys):
+        """the ids of the `(name, value)` features in `keys`, in order."""
+        ids = self.ids
+        missing = [key for key in dict.fromkeys(keys) if key not in ids]
+        for start in range(0, len(missing), self.INSERT_BATCH):
+            batch = missing[start:start + self.INSERT_BATCH]
+            params = {}
+            for (i, (name, value)) in enumerate(batch):
+                params["name{}".format(i)] = name
+                params["value{}".format(i)] = value
+            rows = db.query("""insert into features (name, value) values {}
+                returning id, name, value""".format(", ".join(
+                    "(:name{0}, :value{0})".format(i)
+                    for i in range(len(batch)))), **params)
+            for row in list(rows):
+                ids[(row['name'], row['value'])] = row['id']
+        return [ids[key] for key in keys]
+
+    def forget(self, count):
+        """drop all but the first `count` features from `ids`, once whatever
+        added the rest has been rolled back."""
+        for key in list(self.ids)[count:]:
+            del self.ids[key]
+
+def present_features(info):
+    """the `(name, value)` of each feature `info` has."""
+    return [(feat.shortname, feat.value) for feat in info.features.values()
+        if feat.present]
+
+def store_features(db, feature_ids, cpu_id, info, source=None):
+    """record `info`'s features as `cpu_id`'s `cpu_features`, and evaluate
+    `FEATURES` against every other core type into `core_type_features`.
+    returns the ids of the `cpu_features`."""
+    core_types = [(0, present_features(info))]
+    for core_type in info.core_types[1:]:
+        core_info = AIDAInfo.from_registers(db, {0: core_type.table},
+            msrs=info.core_type_msrs(core_type), source=source)
+        core_types.append((core_type.index, present_features(core_info)))
+
+    ids = iter(feature_ids.ids_of(db,
+        [key for (_, keys) in core_types for key in keys]))
+    cpu_features = []
+    core_type_features = []
+    for (index, keys) in core_types:
+        for (_, feat_id) in zip(keys, ids):
+            if index == 0:
+                cpu_features.append({"cpu": cpu_id, "feature": feat_id})
             else:
-                feat_id = db_feat['id']
+                core_type_features.append({
+                    "cpu": cpu_id,
+                    "core_type": index,
+                    "feature": feat_id,
+                })
+    insert_rows(db, "cpu_features", cpu_features)
+    insert_rows(db, "core_type_features", core_type_features)
+    return [row["feature"] for row in cpu_features]
+
+# fields that identify the logical processor a leaf was read on, rather than
+# anything about the processor: APIC IDs, and AMD's core and node IDs. these
+# differ between cores of the same type, and between readings that are
+# otherwise of the same processor.
+APIC_ID_FIELDS = {
+    (0x00000001, "ebx"): 0xff000000,
+    (0x0000000b, "edx"): 0xffffffff,
+    (0x0000001f, "edx"): 0xffffffff,
+    # AMD's extended APIC ID, core ID and node ID.
+    (0x8000001e, "eax"): 0xffffffff,
+    (0x8000001e, "ebx"): 0x000000ff,
+    (0x8000001e, "ecx"): 0x000000ff,
+    # AMD's extended topology leaf, like 0x1f.
+    (0x80000026, "edx"): 0xffffffff,
+}
+
+# `APIC_ID_FIELDS` as the bits of eax/ebx/ecx/edx to keep, by leaf. every
+# logical cpu is fingerprinted as it's parsed, so this is worth keeping quick.
+APIC_ID_MASKS = dict(
+    (leaf, tuple(~APIC_ID_FIELDS.get((leaf, reg), 0) & 0xffffffff
+        for reg in ("eax", "ebx", "ecx", "edx")))
+    for (leaf, _) in APIC_ID_FIELDS)
+
+CPUID_ROW = struct.Struct("<IIIIII")
+
+def cpuid_fingerprint(table):
+    """a hash of one logical cpu's CPUID table that doesn't depend on the order
+    rows were read in, or on APIC IDs."""
+    pack = CPUID_ROW.pack
+    rows = []
+    for (leaf, subleaf, eax, ebx, ecx, edx) in table.rows():
+        if subleaf is None:
+            subleaf = 0xffffffff
+        masks = APIC_ID_MASKS.get(leaf)
+        if masks is None:
+            rows.append(pack(leaf, subleaf, eax, ebx, ecx, edx))
+        else:
+            rows.append(pack(leaf, subleaf, eax & masks[0], ebx & masks[1],
+                ecx & masks[2], edx & masks[3]))
+    rows.sort()
+    return hashlib.sha256(b"".join(rows)).hexdigest()
+
+class CoreType:
+    """one kind of core in a processor: the CPUID table its logical cpus all
+    read (give or take APIC IDs), and which logical cpus those are. most
+    processors have just one; hybrid parts like Alder Lake have a P-core type
+    and an E-core type, which report different leaves and features."""
+    __slots__ = ("index", "fingerprint", "table", "cpus")
+
+    def __init__(self, fingerprint, table):
+        self.index = None
+        self.fingerprint = fingerprint
+        self.table = table
+        self.cpus = []
+
+def masked_registers(table):
+    """`table`'s packed registers, with `APIC_ID_FIELDS` masked off, as bytes.
+    unlike `cpuid_fingerprint` this depends on the order rows were read in."""
+    regs = array.array("I", table.regs)
+    for (leaf, masks) in APIC_ID_MASKS.items():
+        index = table.leaves.get(leaf)
+        if index is None:
+            continue
+        for i in (index.values() if isinstance(index, dict) else (index,)):
+            i *= 4
+            regs[i] &= masks[0]
+            regs[i + 1] &= masks[1]
+            regs[i + 2] &= masks[2]
+            regs[i + 3] &= masks[3]
+    return regs.tobytes()
+
+class CoreTypeSet:
+    """the `CoreType`s of one processor, as its logical cpus' tables are
+    filed under them."""
+    __slots__ = ("by_fingerprint", "by_registers")
 
-            cpu_features.insert({
+    def __init__(self):
+        self.by_fingerprint = {}
+        # logical cpus nearly always read their rows in the same order as the
+        # one before, so an identical run of masked registers is looked for
+        # before hashing the table. see `masked_registers`.
+        self.by_registers = {}
+
+    def intern(self, cpunum, table):
+        """file logical cpu `cpunum`'s CPUID `table` under its `CoreType`, and
+        return the table to keep for `cpunum`: the first one read with the same
+        fingerprint, so the rest can be thrown away."""
+        registers = masked_registers(table)
+        core_type = self.by_registers.get(registers)
+        if core_type is None or core_type.table.leaves != table.leaves:
+            fingerprint = cpuid_fingerprint(table)
+            core_type = self.by_fingerprint.get(fingerprint)
+            if core_type is None:
+                core_type = CoreType(fingerprint, table)
+                self.by_fingerprint[fingerprint] = core_type
+            self.by_registers[registers] = core_type
+        core_type.cpus.append(cpunum)
+        return core_type.table
+
+    def ordered(self):
+        """the `CoreType`s as a list numbered by their lowest logical cpu, so
+        core type 0 is always the one logical cpu 0 is."""
+        ordered = sorted(self.by_fingerprint.values(),
+            key=lambda t: min(t.cpus))
+        for (index, core_type) in enumerate(ordered):
+            core_type.index = index
+            core_type.cpus.sort()
+        return ordered
+
+def processor_fingerprint(core_types):
+    """a whole processor's fingerprint, from its `CoreType`s. for the usual
+    single core type, that's just its table's fingerprint."""
+    if len(core_types) == 1:
+        return core_types[0].fingerprint
+    return hashlib.sha256(",".join(
+        core_type.fingerprint for core_type in core_types).encode()).hexdigest()
+
+def format_cpu_list(cpus):
+    """`[0, 1, 2, 3, 8]` -> `0-3,8`, the way Linux writes cpu lists."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(lo) if lo == hi else "{}-{}".format(lo, hi)
+        for (lo, hi) in ranges)
+
+def cpuid_table_rows(table_id, table):
+    """flatten a `CPUIDTable` into `cpuid_table_registers` rows."""
+    rows = []
+    for (leaf, subleaf, eax, ebx, ecx, edx) in table.rows():
+        rows.append({
+            "cpuid_table": table_id,
+            "leaf": leaf,
+            "subleaf": subleaf,
+            "eax": eax,
+            "ebx": ebx,
+            "ecx": ecx,
+            "edx": edx,
+        })
+    return rows
+
+def add_register_row(table, row):
+    """put a stored register row back into a `CPUIDTable`."""
+    table.add(row['leaf'], row['subleaf'],
+        row['eax'], row['ebx'], row['ecx'], row['edx'])
+
+def store_core_types(db, cpu_id, core_types):
+    """record `cpu_id`'s core types, storing each one's CPUID table unless an
+    identical table is already stored."""
+    rows = []
+    for core_type in core_types:
+        existing = db['cpuid_tables'].find_one(
+            fingerprint=core_type.fingerprint)
+        if existing:
+            table_id = existing['id']
+        else:
+            table_id = db['cpuid_tables'].insert({
+                "fingerprint": core_type.fingerprint,
+            })
+            insert_rows(db, "cpuid_table_registers",
+                cpuid_table_rows(table_id, core_type.table))
+        rows.append({
+            "cpu": cpu_id,
+            "core_type": core_type.index,
+            "cpuid_table": table_id,
+            "logical_cpus": format_cpu_list(core_type.cpus),
+        })
+    insert_rows(db, "cpu_core_types", rows)
+
+def msr_to_db(value):
+    """an unsigned 64-bit MSR value as the signed integer sqlite can hold."""
+    if value >= 1 << 63:
+        return value - (1 << 64)
+    return value
+
+def msr_from_db(value):
+    return value & 0xffffffffffffffff
+
+def store_msrs(db, cpu_id, info):
+    """record `info.msrs` in `msr_values`, split up by core type."""
+    core_type_of = {}
+    for core_type in info.core_types:
+        for cpu in core_type.cpus:
+            core_type_of[cpu] = core_type.index
+    # the cpus of each core type that MSRs were read from.
+    read_by = {}
+    for cpu in info.msr_cpus:
+        read_by.setdefault(core_type_of.get(cpu), set()).add(cpu)
+
+    rows = []
+    for (index, readings) in info.msrs.items():
+        for (value, cpus) in readings.items():
+            by_core_type = {}
+            for cpu in cpus:
+                by_core_type.setdefault(core_type_of.get(cpu), []).append(cpu)
+            for (core_type, core_type_cpus) in by_core_type.items():
+                if set(core_type_cpus) == read_by[core_type]:
+                    logical_cpus = None
+                else:
+                    logical_cpus = format_cpu_list(core_type_cpus)
+                rows.append({
+                    "cpu": cpu_id,
+                    "core_type": core_type,
+                    "msr": index,
+                    "value": msr_to_db(value),
+                    "logical_cpus": logical_cpus,
+                })
+    insert_rows(db, "msr_values", rows)
+
+def parse_cpu_list(text):
+    """`0-3,8` -> `[0, 1, 2, 3, 8]`, undoing `format_cpu_list`."""
+    cpus = []
+    for part in text.split(","):
+        (lo, _, hi) = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def load_msrs(db):
+    """`{cpu id: {core type: AIDAInfo.msrs}}` for every cpu with stored MSRs."""
+    core_type_cpus = {}
+    for row in db.query("""select cpu, core_type, logical_cpus
+            from cpu_core_types where cpu in (select cpu from msr_values)"""):
+        core_type_cpus[(row['cpu'], row['core_type'])] = row['logical_cpus']
+
+    cpus = {}
+    for row in db.query("""select cpu, core_type, msr, value, logical_cpus
+            from msr_values"""):
+        logical_cpus = row['logical_cpus'] or \
+            core_type_cpus.get((row['cpu'], row['core_type'])) or "0"
+        msrs = cpus.setdefault(row['cpu'], {}).setdefault(row['core_type'], {})
+        msrs.setdefault(row['msr'], {})[msr_from_db(row['value'])] = \
+            parse_cpu_list(logical_cpus)
+    return cpus
+
+def load_cpuid_tables(db):
+    """read every stored CPUID table back into `{table id: table}`."""
+    tables = {}
+    for row in db.query("""select cpuid_table, leaf, subleaf,
+            eax, ebx, ecx, edx from cpuid_table_registers"""):
+        if row['cpuid_table'] not in tables:
+            tables[row['cpuid_table']] = CPUIDTable()
+        add_register_row(tables[row['cpuid_table']], row)
+    return tables
+
+def load_core_types(db, tables):
+    """`{cpu id: {core type: table}}` for every cpu with stored registers, out
+    of `load_cpuid_tables`. a table shared by several cpus is shared here too.
+    """
+    cpus = {}
+    for row in db.query("""select cpu, core_type, cpuid_table
+            from cpu_core_types"""):
+        cpus.setdefault(row['cpu'], {})[row['core_type']] = \
+            tables.get(row['cpuid_table']) or CPUIDTable()
+    return cpus
+
+def rederive(dbpath):
+    """re-evaluate `FEATURES` for every cpu from its stored CPUID registers and
+    rewrite its `cpu_features`, `core_type_features`, family and uarch. this is
+    what to run after adding or fixing a feature definition, instead of
+    re-ingesting the corpus. cpus ingested before registers were stored are
+    left as they are."""
+    db = open_db(dbpath)
+
+    start = time.monotonic()
+
+    tables = load_cpuid_tables(db)
+
+    db.begin()
+    feature_ids = FeatureIds(db)
+    refingerprint_cpuid_tables(db, tables)
+    cpus = load_core_types(db, tables)
+    msrs = load_msrs(db)
+    sources = dict((row['id'], row['source']) for row in
+        db.query("select id, source from cpus"))
+
+    # every stored table's bitfields at once, rather than cpu by cpu.
+    batch = None
+    if FeatureMatrix.available():
+        batch = FeatureMatrix(FEATURE_PLAN, tables.values())
+
+    cpu_rows = []
+    cpu_feature_rows = []
+    core_type_feature_rows = []
+    for (cpu_id, core_types) in cpus.items():
+        cpu_msrs = msrs.get(cpu_id, {})
+        info = AIDAInfo.from_registers(db, dict(core_types),
+            msrs=cpu_msrs.get(0), source=sources[cpu_id], batch=batch)
+        family = info.feature("family")
+        uarch = info.feature("uarch")
+        cpu_rows.append({
+            "id": cpu_id,
+            "fingerprint": processor_fingerprint(info.core_types),
+            "name": info.proc_name(),
+            "family": family.value if family else None,
+            "uarch": uarch.value if uarch else None,
+            "feature_mask": feature_ids.mask(present_features(info)),
+        })
+
+        for feat_id in feature_ids.ids_of(db, present_features(info)):
+            cpu_feature_rows.append({
                 "cpu": cpu_id,
-                "feature": feat_id
+                "feature": feat_id,
             })
 
-def get_interesting(vendor, features):
-    print("vendor: {}".format(vendor))
-    predicate = ' and '.join(
-        ["cpus.id in has_{}".format(
-            f['name'].replace(" ", "SP")) for f in features]
-    )
-    if not vendor:
-        return """
-        interesting as (
-            select cpus.id from cpus where
-                {}
-        ),
-        not_interesting as (
-            select cpus.id from cpus where
-                cpus.id not in interesting
-        )
-        """.format(predicate)
-    else:
-        return """
-        vendorid as (
-            select id from vendors where name="{}"
-        ),
-        interesting as (
-            select cpus.id from cpus join families on cpus.family=families.id where
-                {} and families.vendor in vendorid
-        ),
-        not_interesting as (
-            select cpus.id from cpus join families on cpus.family=families.id where
-                cpus.id not in interesting
-                and families.id in vendorid
-        )
-        """.format(vendor, predicate)
-
-def get_predicate_cte(featrule):
-    mangled = featrule['name'].replace(" ", "SP")
-    print(featrule['name'])
-    return """
-        has_{} as (
-            select cpu_features.cpu from cpu_features
-                join features on cpu_features.feature=features.id
-            where features.name="{}" and features.value{}"{}"
-        ),""".format(mangled, featrule['name'], featrule['op'],
-                featrule['value'])
-
-def get_interesting_ctes(vendor, features):
-    pat = "([A-Za-z0-9 ]+)(:?(=|!=|>|<|>=|<=)([A-Za-z0-9]+))?"
-
-    feature_rules = []
-
-    for feat in features:
-        feature_parse = re.match(pat, feat)
-
-        if not feature_parse:
-            raise Exception("can't parse feature test: '{}'".format(feat))
+        for (index, table) in core_types.items():
+            if index == 0:
+                continue
+            core_info = AIDAInfo.from_registers(db, {0: table},
+                msrs=cpu_msrs.get(index), source=sources[cpu_id], batch=batch)
+            for feat_id in feature_ids.ids_of(db,
+                    present_features(core_info)):
+                core_type_feature_rows.append({
+                    "cpu": cpu_id,
+                    "core_type": index,
+                    "feature": feat_id,
+                })
 
-        name = feature_parse.group(1)
+    if cpu_rows:
+        db.executable.execute(sqlalchemy.text("""update cpus set
+            fingerprint=:fingerprint, name=:name, family=:family, uarch=:uarch,
+            feature_mask=:feature_mask where id=:id"""), cpu_rows)
+    db.query("""delete from cpu_features where cpu in
+        (select distinct cpu from cpu_core_types)""")
+    insert_rows(db, "cpu_features", cpu_feature_rows)
+    db.query("delete from core_type_features")
+    insert_rows(db, "core_type_features", core_type_feature_rows)
+    # families, uarches and features can all have changed, so `coverage` is
+    # easier counted again than patched cpu by cpu.
+    rebuild_coverage(db.query)
+    db.commit()
+
+    skipped = db['cpus'].count() - len(cpus)
+    print("rederived features for {} cpus in {:.1f}s ({} without stored "
+        "registers left alone)".format(
+            len(cpus), time.monotonic() - start, skipped))
+
+def refingerprint_cpuid_tables(db, tables):
+    """recompute the fingerprint of every stored CPUID table in `tables`, in
+    case `APIC_ID_FIELDS` has changed since they were stored. tables that turn
+    out to be identical after all are merged into one."""
+    db.query("update cpuid_tables set fingerprint=NULL")
+    kept = {}
+    for (table_id, table) in sorted(tables.items()):
+        fingerprint = cpuid_fingerprint(table)
+        if fingerprint in kept:
+            db.query("""update cpu_core_types set cpuid_table=:kept
+                where cpuid_table=:merged""",
+                kept=kept[fingerprint], merged=table_id)
+            db['cpuid_table_registers'].delete(cpuid_table=table_id)
+            db['cpuid_tables'].delete(id=table_id)
+            del tables[table_id]
+        else:
+            kept[fingerprint] = table_id
+            db['cpuid_tables'].update({
+                "id": table_id,
+                "fingerprint": fingerprint,
+            }, ["id"])
+
+def remove_cpu(db, cpu_id, coverage_delta=None):
+    """delete a cpu and everything recorded about it. `coverage_delta` is the
+    `CoverageDelta` to take it out of `coverage` in, if there is one."""
+    table_ids = [row['cpuid_table'] for row in
+        db['cpu_core_types'].find(cpu=cpu_id)]
+    cpu = db['cpus'].find_one(id=cpu_id)
+    if cpu:
+        delta = coverage_delta or CoverageDelta()
+        delta.count(cpu['family'], cpu['uarch'],
+            [row['feature'] for row in db['cpu_features'].find(cpu=cpu_id)],
+            -1)
+        if coverage_delta is None:
+            delta.apply(db)
+    db['cpu_features'].delete(cpu=cpu_id)
+    db['core_type_features'].delete(cpu=cpu_id)
+    db['msr_values'].delete(cpu=cpu_id)
+    db['cpu_core_types'].delete(cpu=cpu_id)
+    db['cpus'].delete(id=cpu_id)
+    # CPUID tables no other cpu has a core of go too.
+    for table_id in table_ids:
+        if not db['cpu_core_types'].count(cpuid_table=table_id):
+            db['cpuid_table_registers'].delete(cpuid_table=table_id)
+            db['cpuid_tables'].delete(id=table_id)
+
+def show_core_types(dbpath, name=None):
+    """list cpus with more than one core type, and how each core type's
+    features differ from core type 0's. `name` limits this to cpus with that
+    in their name."""
+    db = open_db(dbpath)
+
+    rows = list(db.query("""select cpus.id, cpus.name, cpu_core_types.core_type,
+            cpu_core_types.logical_cpus
+        from cpu_core_types join cpus on cpus.id = cpu_core_types.cpu
+        where cpu_core_types.cpu in (
+            select cpu from cpu_core_types where core_type > 0)
+        order by cpus.name, cpus.id, cpu_core_types.core_type"""))
+
+    current = None
+    for row in rows:
+        if name is not None and name.lower() not in row['name'].lower():
+            continue
+        if row['id'] != current:
+            current = row['id']
+            print(row['name'])
+            base = set((feat['name'], feat['value']) for feat in db.query(
+                """select features.name, features.value from cpu_features
+                join features on features.id = cpu_features.feature
+                where cpu_features.cpu=:cpu""", cpu=current))
+        print("  core type {}: logical cpus {}".format(
+            row['core_type'], row['logical_cpus']))
+        if row['core_type'] == 0:
+            continue
+        feats = set((feat['name'], feat['value']) for feat in db.query(
+            """select features.name, features.value from core_type_features
+            join features on features.id = core_type_features.feature
+            where core_type_features.cpu=:cpu and
+                core_type_features.core_type=:core_type""",
+            cpu=current, core_type=row['core_type']))
+        for (feat_name, value) in sorted(feats - base, key=str):
+            print("    + {} = {}".format(feat_name, value))
+        for (feat_name, value) in sorted(base - feats, key=str):
+            print("    - {} = {}".format(feat_name, value))
+
+def source_unchanged(db, source):
+    """has `source` been ingested before, byte for byte as it is now? a matching
+    size and mtime is taken at its word; otherwise the contents are hashed. a
+    touched-but-identical dump has its manifest entry refreshed so the next
+    check is cheap again."""
+    known = db['sources'].find_one(path=source.name)
+    if known is None:
+        return False
+    if known['size'] == source.size and known['mtime_ns'] == source.mtime_ns:
+        return True
+    if known['sha256'] == source.sha256():
+        db['sources'].update({
+            "path": source.name,
+            "size": source.size,
+            "mtime_ns": source.mtime_ns,
+        }, ["path"])
+        return True
+    return False
+
+def ingest_info(db, source, info, feature_ids=None, coverage_delta=None):
+    """add `info`, parsed from `source`, and note it in the `sources` manifest.
+    if `source` was ingested before with different contents, whatever it was
+    recorded as is replaced. returns True if a new cpu was added."""
+    manifest = db['sources']
+    known = manifest.find_one(path=source.name)
+    if known is not None and known['sha256'] != source.sha256() and \
+            known['cpu'] is not None and \
+            manifest.count(cpu=known['cpu']) == 1:
+        # the changed dump was the only reading of that cpu, so it goes. if
+        # it's still distinct it's added right back, below.
+        remove_cpu(db, known['cpu'], coverage_delta)
+
+    (cpu_id, added) = add_info(db, info, source.name, feature_ids,
+        coverage_delta)
+
+    manifest.upsert({
+        "path": source.name,
+        "size": source.size,
+        "mtime_ns": source.mtime_ns,
+        "sha256": source.sha256(),
+        "cpu": cpu_id,
+    }, ["path"])
+
+    return added
 
-        op = feature_parse.group(3)
-        value = feature_parse.group(4)
+def add(dbpath, cpuid_filename):
+    db = open_db(dbpath)
+
+    source = CPUIDSource(cpuid_filename, path=cpuid_filename)
+    with source.open() as f:
+        info = AIDAInfo(db, f, source=source.name)
+
+    db.begin()
+    ingest_info(db, source, info)
+    db.commit()
+
+def parse_source(source):
+    """parse one CPUID dump without a database. this is what ingest workers run,
+    so failures are returned rather than raised to keep them picklable."""
+    try:
+        with source.open() as f:
+            return (AIDAInfo(None, f, source=source.name), None)
+    except Exception as e:
+        return (None, str(e))
+
+def parse_sources(sources, jobs=1):
+    """yield `(source, info, error)` for each of `sources`, in order. with
+    `jobs > 1` dumps are parsed by a pool of worker processes, but no more than
+    a few per worker are ever in flight so a slow writer holds back parsing
+    instead of buffering the whole corpus in memory."""
+    if jobs <= 1:
+        for source in sources:
+            yield (source,) + parse_source(source)
+        return
+
+    in_flight = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for source in sources:
+            if len(in_flight) >= jobs * 4:
+                (done, future) = in_flight.popleft()
+                yield (done,) + future.result()
+            in_flight.append((source, pool.submit(parse_source, source)))
+        while in_flight:
+            (done, future) = in_flight.popleft()
+            yield (done,) + future.result()
+
+def ingest(db, sources, batch_size=1000, jobs=1, incremental=False):
+    """ingest `sources` into `db`, committing every `batch_size` dumps. a dump
+    that fails to parse is reported and skipped rather than aborting the whole
+    run.
+
+    parsing is spread over `jobs` processes; this process is the only one that
+    touches the database.
+
+    with `incremental`, dumps that are byte-identical to when they were last
+    ingested are skipped before they're parsed, and changed ones replace what
+    they were previously recorded as."""
+    start = time.monotonic()
+    done = 0
+    added = 0
+    failed = 0
+    unchanged = 0
+
+    reported = None
+
+    def report():
+        nonlocal reported
+        elapsed = time.monotonic() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print("{} files ({} added, {} unchanged, {} failed) in {:.1f}s, "
+            "{:.1f} files/sec".format(
+                done, added, unchanged, failed, elapsed, rate))
+        reported = done
+
+    def changed_sources():
+        nonlocal done, unchanged
+        for source in sources:
+            if incremental and source_unchanged(db, source):
+                done += 1
+                unchanged += 1
+                continue
+            yield source
+
+    db.begin()
+    feature_ids = FeatureIds(db)
+    # `coverage` is brought up to date once per batch, just before it's
+    # committed.
+    coverage_delta = CoverageDelta()
+    uncommitted = 0
+    for (source, info, error) in parse_sources(changed_sources(), jobs):
+        if error is not None:
+            print("could not parse {}: {}".format(source.name, error))
+            failed += 1
+        else:
+            # each dump is written under its own savepoint, so one that can't
+            # be recorded is skipped rather than losing the whole batch.
+            known = len(feature_ids.ids)
+            source_delta = CoverageDelta()
+            # pysqlite only really begins a transaction at the first write,
+            # and a savepoint outside of one is its own transaction, which
+            # releasing it would commit.
+            if not db.executable.connection.dbapi_connection.in_transaction:
+                db.query("begin")
+            db.query("savepoint ingest_source")
+            try:
+                info.resolve(db)
+                if ingest_info(db, source, info, feature_ids, source_delta):
+                    added += 1
+            except Exception as e:
+                db.query("rollback to ingest_source")
+                feature_ids.forget(known)
+                print("could not ingest {}: {}".format(source.name, e))
+                failed += 1
+            else:
+                coverage_delta.merge(source_delta)
+            db.query("release ingest_source")
+
+        done += 1
+        uncommitted += 1
+        if uncommitted == batch_size:
+            coverage_delta.apply(db)
+            db.commit()
+            report()
+            db.begin()
+            uncommitted = 0
+    coverage_delta.apply(db)
+    db.commit()
+
+    if reported != done:
+        report()
+
+def add_many(dbpath, paths, batch_size=1000, jobs=1,
+        pattern=CPUID_FILE_PATTERN, incremental=False):
+    """ingest every CPUID dump under `paths` with one database connection. see
+    `ingest`."""
+    db = open_db(dbpath)
+    ingest(db, iter_sources(paths, pattern), batch_size=batch_size, jobs=jobs,
+        incremental=incremental)
+
+class InotifyWatcher:
+    """reports files under `root` that were written or moved into place, using
+    inotify(7) through libc. `available()` says if this can work here at all."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct("iIII")
+
+    @staticmethod
+    def libc():
+        name = ctypes.util.find_library("c")
+        if name is None:
+            return None
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            return None
+        return libc
+
+    @classmethod
+    def available(cls):
+        return sys.platform.startswith("linux") and cls.libc() is not None
+
+    def __init__(self, root):
+        self.lib = self.libc()
+        self.fd = self.lib.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        for (dirpath, _, _) in os.walk(root):
+            self.watch_dir(dirpath)
+
+    def watch_dir(self, path):
+        wd = self.lib.inotify_add_watch(self.fd, os.fsencode(path),
+            self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "can't watch {}".format(path))
+        self.dirs[wd] = path
+
+    def changes(self, timeout=None):
+        """wait up to `timeout` seconds (forever for None) for something to
+        change, and return the set of changed files."""
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        buf = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, _, length) = self.EVENT.unpack_from(buf, offset)
+            offset += self.EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # a new directory. anything already written into it before
+                    # the watch was set up is picked up by walking it.
+                    for (dirpath, _, filenames) in os.walk(path):
+                        self.watch_dir(dirpath)
+                        changed.update(os.path.join(dirpath, filename)
+                            for filename in filenames)
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                changed.add(path)
+        return changed
+
+class PollingWatcher:
+    """`InotifyWatcher`, for everywhere else: rescans `root` every `interval`
+    seconds and reports files whose size or mtime changed."""
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self.seen = self.scan()
+
+    def scan(self):
+        seen = {}
+        for (dirpath, _, filenames) in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                seen[path] = (st.st_size, st.st_mtime_ns)
+        return seen
+
+    def changes(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.monotonic(), 0))
+            time.sleep(wait)
+            seen = self.scan()
+            changed = set(path for (path, stat) in seen.items()
+                if self.seen.get(path) != stat)
+            self.seen = seen
+            if changed or (deadline is not None and
+                    time.monotonic() >= deadline):
+                return changed
+
+def watch(dbpath, root, settle=2.0, max_delay=30.0, interval=1.0, jobs=1,
+        pattern=CPUID_FILE_PATTERN, poll=False, batch_size=1000):
+    """keep `dbpath` up to date with the CPUID dumps under `root`. anything new
+    or changed since the last run is ingested first, then new dumps are ingested
+    as they land. bursts of files are coalesced: a batch is ingested once
+    `root` has been quiet for `settle` seconds, or after `max_delay` seconds if
+    files just keep coming, committing every `batch_size` files."""
+    db = open_db(dbpath)
+
+    # the watcher starts before catching up, so whatever lands while that runs
+    # is reported straight after. dumps it reports that the catch-up got to
+    # anyway are skipped as unchanged.
+    if not poll and InotifyWatcher.available():
+        watcher = InotifyWatcher(root)
+    else:
+        if not poll:
+            print("inotify isn't available, polling every {}s".format(
+                interval))
+        watcher = PollingWatcher(root, interval)
+
+    ingest(db, iter_sources([root], pattern), batch_size=batch_size,
+        jobs=jobs, incremental=True)
+
+    pending = set()
+    first_pending = None
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = min(settle,
+                    max(first_pending + max_delay - time.monotonic(), 0))
+            changed = set(path for path in watcher.changes(timeout)
+                if cpuid_file_name_matches(path, pattern))
+            if changed and not pending:
+                first_pending = time.monotonic()
+            pending |= changed
+
+            if not pending:
+                continue
+            if changed and time.monotonic() - first_pending < max_delay:
+                continue
 
+            sources = [CPUIDSource(path, path=path)
+                for path in sorted(pending) if os.path.isfile(path)]
+            pending = set()
+            ingest(db, sources, batch_size=batch_size, jobs=jobs,
+                incremental=True)
+    except KeyboardInterrupt:
+        pass
+
+def parse_bench(paths, repeat=1, memory=False):
+    """time `AIDAInfo` over the dumps under `paths` and report lines/sec. files
+    are read up front so only parsing is measured. with `memory`, also report
+    the most memory parsing any one dump took at its peak and kept afterward,
+    which is measured in a separate pass since tracing allocations is slow."""
+    texts = []
+    for source in iter_sources(paths):
+        with source.open() as f:
+            texts.append((source.name, f.readlines()))
+
+    lines = sum(len(text) for (_, text) in texts) * repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for (source_name, text) in texts:
+            try:
+                AIDAInfo(None, text, source=source_name)
+            except Exception as e:
+                print("could not parse {}: {}".format(source_name, e))
+    elapsed = time.perf_counter() - start
+
+    print("{} files, {} lines in {:.3f}s: {:.0f} lines/sec".format(
+        len(texts) * repeat, lines, elapsed, lines / elapsed))
+
+    if not memory:
+        return
+
+    peak = (0, None)
+    kept = (0, None)
+    tracemalloc.start()
+    for (source_name, text) in texts:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            info = AIDAInfo(None, text, source=source_name)
+        except Exception:
+            continue
+        (current, highest) = tracemalloc.get_traced_memory()
+        peak = max(peak, (highest - before, source_name))
+        kept = max(kept, (current - before, source_name))
+        del info
+    tracemalloc.stop()
+
+    print("peak {:.1f} KiB parsing {}".format(peak[0] / 1024, peak[1]))
+    print("largest result {:.1f} KiB, for {}".format(kept[0] / 1024, kept[1]))
+
+def parse_signature(text):
+    """a leaf 1 eax written in hex, as `000906EA`, `0x906ea` or `906EAh`."""
+    text = text.strip()
+    if text[-1:] in ("h", "H"):
+        text = text[:-1]
+    return int(text, 16)
+
+def classify_signatures(dbpath, vendor, lines, out=sys.stdout):
+    """print the uarch and family of each CPUID signature in `lines`, which are
+    `<vendor> <leaf 1 eax>`, or just the eax if `vendor` is given. `dbpath`
+    may be None to use `product_info.sql` as it is."""
+    db = open_query_db(dbpath) if dbpath is not None else None
+    resolver = uarch_resolver(db)
+
+    # readings of one fleet tend to repeat the same handful of signatures.
+    seen = {}
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        text = seen.get((vendor, line))
+        if text is None:
+            if vendor is None:
+                (line_vendor, signature) = line.split(None, 1)
+            else:
+                (line_vendor, signature) = (vendor, line)
+            eax = parse_signature(signature)
+            uarch = resolver.classify(line_vendor, eax)
+            if uarch is None:
+                text = "{}\t{:08X}\tunknown\tunknown".format(line_vendor, eax)
+            else:
+                text = "{}\t{:08X}\t{}\t{}".format(line_vendor, eax,
+                    uarch.name, uarch.family_name)
+            seen[(vendor, line)] = text
+        batch.append(text)
+        if len(batch) >= 65536:
+            out.write("\n".join(batch) + "\n")
+            batch = []
+    if batch:
+        out.write("\n".join(batch) + "\n")
+
+# a feature expression is what the query commands take: terms like `AVX2`,
+# `FamilyID=15` or `"max CCLK">=4000`, combined with `and`, `or`, `not` and
+# parentheses. a bare name means the feature is there and non-zero, terms next
+# to each other are and-ed, and a name (or value) with spaces in it is either
+# quoted or an argument of its own. `vendor`, `family`, `uarch` and `virtual`
+# are about the cpu rather than its features: `family="Zen 3"`, `virtual=0`.
+FEATURE_EXPRESSION_TOKEN = re.compile(r"""\s*(?:
+    (?P<paren>[()]) |
+    (?P<op>!=|>=|<=|=|>|<) |
+    '(?P<squoted>[^']*)' | "(?P<dquoted>[^"]*)" |
+    (?P<word>[^\s()=!<>'"]+))""", re.VERBOSE)
+
+FEATURE_EXPRESSION_KEYWORDS = ("and", "or", "not")
+
+# the terms that filter on a column of `cpus` rather than on `cpu_features`.
+CPU_ATTRIBUTES = ("vendor", "family", "uarch", "virtual")
+
+FEATURE_NAMES = set(feature.shortname for feature in FEATURES)
+
+def tokenize_feature_expression(args):
+    """`(kind, text)` tokens of the feature expression in `args`, a list of
+    strings. each string ends a term, so `["AVX2", "BMI2"]` is two names where
+    `["AVX2 BMI2"]` is one, and a string that's exactly a feature's name is
+    that name even if it has `=` or parentheses in it."""
+    tokens = []
+    for arg in args:
+        if arg in FEATURE_NAMES:
+            tokens += [("quoted", arg), ("end", None)]
+            continue
+        pos = 0
+        while arg[pos:].strip():
+            match = FEATURE_EXPRESSION_TOKEN.match(arg, pos)
+            if not match:
+                raise Exception("can't parse feature expression at '{}'".format(
+                    arg[pos:]))
+            pos = match.end()
+            kind = match.lastgroup
+            text = match.group(kind)
+            if kind in ("squoted", "dquoted"):
+                kind = "quoted"
+            elif kind == "word" and text.lower() in FEATURE_EXPRESSION_KEYWORDS:
+                kind = text.lower()
+            tokens.append((kind, text))
+        tokens.append(("end", None))
+    return tokens
+
+def parse_feature_value(text):
+    """a value in a feature expression: an integer if it reads as one
+    (`3000`, `0x1f`), so comparisons are numeric, or else a string."""
+    for base in (0, 10):
+        try:
+            return int(text, base)
+        except ValueError:
+            pass
+    return text
+
+def parse_feature_expression(args):
+    """parse the feature expression in `args` into a tree of tuples:
+    `("and", [node, ...])`, `("or", [node, ...])`, `("not", node)` or
+    `("term", name, op, value)`, where `op` and `value` are None for a bare
+    name, and `value` is `(low, high)` for `between`."""
+    tokens = tokenize_feature_expression(args)
+    if not tokens:
+        raise Exception("no features given")
+    pos = 0
+
+    def peek():
+        while tokens[pos][0] == "end" and pos + 1 < len(tokens):
+            skip()
+        return tokens[pos][0]
+
+    def skip():
+        nonlocal pos
+        pos += 1
+
+    def words(name=False):
+        # values run until something that isn't a word, so `family=Zen 3`
+        # works unquoted. names are the most words that make up a known name,
+        # so `base CCLK>=3000` and `AVX2 BMI2` are both what they look like.
+        # a quoted name or value is the whole of one, whatever follows it.
+        peek()
+        parts = []
+        while tokens[pos + len(parts)][0] == "word" or \
+                tokens[pos + len(parts)][0] == "quoted" and not parts:
+            parts.append(tokens[pos + len(parts)][1])
+            if tokens[pos + len(parts) - 1][0] == "quoted":
+                break
+        if not parts:
+            raise Exception("expected a feature name or value, found {}".format(
+                tokens[pos][1] or "the end of the expression"))
+        count = len(parts)
+        if name:
+            count = next((n for n in range(len(parts), 0, -1)
+                if " ".join(parts[:n]) in FEATURE_NAMES or
+                    " ".join(parts[:n]) in CPU_ATTRIBUTES), 1)
+        for _ in range(count):
+            skip()
+        return " ".join(parts[:count])
+
+    def expression():
+        nodes = [conjunction()]
+        while peek() == "or":
+            skip()
+            nodes.append(conjunction())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def conjunction():
+        nodes = [unary()]
+        while peek() in ("and", "not", "paren", "word", "quoted") and \
+                tokens[pos] != ("paren", ")"):
+            if peek() == "and":
+                skip()
+            nodes.append(unary())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def unary():
+        kind = peek()
+        if kind == "not":
+            skip()
+            return ("not", unary())
+        if tokens[pos] == ("paren", "("):
+            skip()
+            node = expression()
+            if peek() != "paren":
+                raise Exception("missing ) in feature expression")
+            skip()
+            return node
+        name = words(name=True)
+        if tokens[pos][0] == "word" and tokens[pos][1].lower() == "between":
+            skip()
+            low = parse_feature_value(words())
+            if peek() != "and":
+                raise Exception("expected 'and' in {} between ...".format(name))
+            skip()
+            return ("term", name, "between", (low, parse_feature_value(words())))
+        if tokens[pos][0] != "op":
+            return ("term", name, None, None)
+        op = tokens[pos][1]
+        skip()
+        return ("term", name, op, parse_feature_value(words()))
+
+    if peek() == "end":
+        raise Exception("no features given")
+    node = expression()
+    if peek() != "end":
+        raise Exception("unexpected {} in feature expression".format(
+            tokens[pos][1]))
+    return node
+
+def feature_expression_terms(node):
+    """every `("term", ...)` in `node`."""
+    if node[0] == "term":
+        return [node]
+    if node[0] == "not":
+        return feature_expression_terms(node[1])
+    return [term for child in node[1] for term in
+        feature_expression_terms(child)]
+
+def compile_feature_expression(node, params):
+    """a compound select of the ids of the cpus that match `node`: each term is
+    the cpus with a feature value, found through `features (name, value)` and
+    `cpu_features`' key, and `and`, `or` and `not` are INTERSECT, UNION and
+    EXCEPT. values are bound as parameters, added to `params`."""
+    def operand(child):
+        sql = compile_feature_expression(child, params)
+        if child[0] == "term":
+            return sql
+        # compound selects can't be parenthesized, only selected from.
+        return "select * from ({})".format(sql)
+
+    if node[0] == "and" or node[0] == "or":
+        return " {} ".format({"and": "intersect", "or": "union"}[node[0]]).join(
+            operand(child) for child in node[1])
+    if node[0] == "not":
+        return "select id from cpus except {}".format(operand(node[1]))
+
+    (_, name, op, value) = node
+    param = "p{}".format(len(params))
+    if name in CPU_ATTRIBUTES:
         if op is None:
-            op = "!="
-
-        if value is None:
-            value = "0"
-
-        feature_rules.append({ "name": name, "op": op, "value": value })
-
-    predicates = [get_predicate_cte(feat) for feat in feature_rules]
-
-    return "with " + "".join(predicates) + get_interesting(vendor, feature_rules)
+            raise Exception("{} needs a value, like {}=...".format(name, name))
+        if name == "virtual":
+            return """select id from cpus
+                where {}""".format(compare('ifnull("virtual", 0)', name, op,
+                    value, param, params))
+        params[param] = value
+        if op not in ("=", "!="):
+            raise Exception("{} can only be compared with = or !=".format(name))
+        if name == "vendor":
+            matches = """family in (select families.id from families
+                join vendors on vendors.id = families.vendor
+                where vendors.name = :{0} collate nocase or
+                    vendors.brandstring = :{0})""".format(param)
+        elif isinstance(value, int):
+            matches = "{} = :{}".format(name, param)
+        else:
+            matches = """{} in (select id from {}
+                where name = :{} collate nocase)""".format(name,
+                    {"family": "families", "uarch": "uarches"}[name], param)
+        return "select id from cpus where {}ifnull({}, 0)".format(
+            "not " if op == "!=" else "", matches)
+
+    if name not in FEATURE_NAMES:
+        raise Exception("unknown feature '{}'".format(name))
+    if op is None:
+        (op, value) = ("!=", 0)
+    params[param] = name
+    return """select cpu_features.cpu from features
+        join cpu_features on cpu_features.feature = features.id
+        where features.name = :{} and {}""".format(param,
+            compare("features.value", name, op, value, param + "v", params))
+
+# comparisons that only mean anything between numbers.
+RANGE_OPS = ("<", ">", "<=", ">=", "between")
+
+def compare(column, name, op, value, param, params):
+    """SQL comparing `column` to `value` (bound as `param`) with `op`, for
+    feature or attribute `name`. range comparisons have to be against
+    integers: feature values other than `vendor` are stored as integers, so
+    these are numeric, and a range over `features (name, value)`."""
+    values = value if op == "between" else (value,)
+    if op in RANGE_OPS and \
+            not all(isinstance(value, int) for value in values):
+        raise Exception("{} {} needs a number, not {}".format(name, op,
+            " and ".join(str(value) for value in values)))
+    if op == "between":
+        params[param] = values[0]
+        params[param + "high"] = values[1]
+        return "{0} between :{1} and :{1}high".format(column, param)
+    params[param] = value
+    return "{} {} :{}".format(column, op, param)
+
+def cpu_matches_query(vendor, features):
+    """`(sql, params)` for a `matches` CTE with a row for every cpu (of
+    `vendor`, if given): `id`, `name`, `family`, and `matched`, whether it
+    matches the feature expression `features`. the whole expression is one
+    compound select, evaluated once."""
+    params = {}
+    matched = compile_feature_expression(parse_feature_expression(features),
+        params)
+
+    where = ""
+    if vendor is not None:
+        params["vendor"] = vendor
+        where = """where cpus.family in (select families.id from families
+            join vendors on vendors.id = families.vendor
+            where vendors.name = :vendor)"""
+
+    return ("""with matches as (
+        select cpus.id, cpus.name, cpus.family, cpus.id in ({}) as matched
+        from cpus {})""".format(matched, where), params)
 
 def cpus_with_query(vendor, features):
-    return get_interesting_ctes(vendor, features) + \
-        """ select distinct cpus.id, cpus.name from cpus \
-        where cpus.id in interesting;"""
+    (matches, params) = cpu_matches_query(vendor, features)
+    return (matches + """ select id, name from matches where matched
+        order by id""", params)
 
 def cpus_without_query(vendor, features):
-    return get_interesting_ctes(features) + \
-        """ select distinct cpus.id, cpus.name from cpus \
-        where cpus.id in not_interesting;"""
+    (matches, params) = cpu_matches_query(vendor, features)
+    return (matches + """ select id, name from matches where not matched
+        order by id""", params)
 
 def families_with_query(vendor, features):
-    return get_interesting_ctes(vendor, features) + \
-        """ select distinct families.id, families.name from cpus join families \
-        on cpus.family=families.id where cpus.id in interesting;"""
+    (matches, params) = cpu_matches_query(vendor, features)
+    return (matches + """ select families.id, families.name from matches
+        join families on families.id = matches.family
+        group by families.id having max(matched) order by families.id""",
+        params)
 
 def families_without_query(vendor, features):
-    return get_interesting_ctes(vendor, features) + \
-        """ select distinct families.id, families.name from cpus join families \
-        on cpus.family=families.id where cpus.id in not_interesting;"""
-
+    (matches, params) = cpu_matches_query(vendor, features)
+    return (matches + """ select families.id, families.name from matches
+        join families on families.id = matches.family
+        group by families.id having not min(matched) order by families.id""",
+        params)
 
 def families_transitioning_query(vendor, features):
-    return get_interesting_ctes(vendor, features) + \
-        """ select * from families where
-            families.id in interesting and
-            families.id in not_interesting;"""
-
-def features_in_family(dbpath, family):
-    db = dataset.connect("sqlite:///{}".format(dbpath))
-    fam_id = db['families'].find_one(name=family)['id']
-    cpus_in_fam = db.query(
-        "select count(cpus.id) from cpus where cpus.family={};".format(fam_id))
-    cpus_in_fam = cpus_in_fam.next()['count(cpus.id)']
-    ext_in_all = []
-    ext_in_some = []
-
-    for ext in ISA_EXTENSIONS:
-        name = ext.shortname
-        feat_id = None
-        feat = db['features'].find_one(name=name, value=1)
-        if feat:
-            feat_id = feat['id']
+    """families with some cpus that match and some that don't."""
+    (matches, params) = cpu_matches_query(vendor, features)
+    return (matches + """ select families.id, families.name from matches
+        join families on families.id = matches.family
+        group by families.id having max(matched) and not min(matched)
+        order by families.id""", params)
+
+# which families `families_coverage_query` finds, given `covered`, how many of a
+# family's cpus match, and `cpus`, how many it has.
+FAMILIES_COVERED = {
+    "with": "covered > 0",
+    "without": "covered < cpus",
+    "transitioning": "covered > 0 and covered < cpus",
+}
+
+def families_coverage_query(db, vendor, features, which):
+    """`(sql, params)` for the families `which` of `FAMILIES_COVERED` that
+    reads `coverage` instead of every cpu, or None if `features` isn't a single
+    feature term or `not` one. `coverage` counts cpus one feature at a time,
+    so it can't say how many cpus match two terms at once."""
+    node = parse_feature_expression(features)
+    negated = node[0] == "not"
+    if negated:
+        node = node[1]
+    if node[0] != "term" or node[1] in CPU_ATTRIBUTES or \
+            node[1] not in FEATURE_NAMES:
+        return None
+
+    (_, name, op, value) = node
+    if op is None:
+        (op, value) = ("!=", 0)
+    params = {"p0": name}
+    matched = compare("features.value", name, op, value, "p0v", params)
+    covered = "ifnull(matching.cpus, 0)"
+    if negated:
+        covered = "family_totals.cpus - " + covered
+    where = ""
+    if vendor is not None:
+        params["vendor"] = vendor
+        where = """where family_totals.family in (select families.id
+            from families join vendors on vendors.id = families.vendor
+            where vendors.name = :vendor)"""
+
+    return (coverage_counts(db, "features.name = :p0 and " + matched) + """,
+        family_totals as (
+            select family, sum(cpus) as cpus from totals group by family),
+        matching as (select family, sum(cpus_with) as cpus
+            from counts group by family)
+        select id, name from (
+            select families.id, families.name, {} as covered,
+                family_totals.cpus as cpus
+            from family_totals
+            join families on families.id = family_totals.family
+            left join matching on matching.family = family_totals.family
+            {})
+        where {} order by id""".format(covered, where,
+            FAMILIES_COVERED[which]), params)
+
+def print_families(dbpath, vendor, features, which, query):
+    """print the families `which` of `FAMILIES_COVERED`, from `coverage` if
+    `families_coverage_query` can, or else from `query`, one of the
+    `families_*_query`."""
+    db = open_query_db(dbpath)
+    (sql, params) = families_coverage_query(db, vendor, features, which) or \
+        query(vendor, features)
+    for family in db.query(sql, **params):
+        print(family['name'])
+
+class FeatureMasks:
+    """every cpu's `feature_mask`, read once, for evaluating feature expressions
+    made only of boolean feature names without going through `cpu_features` at
+    all. `vendor` limits this to that vendor's cpus."""
+    def __init__(self, db, vendor=None):
+        # rows are read as plain tuples: `db.query` makes a dict of each one,
+        # which takes several times longer than the rest of this put together.
+        execute = db.executable.execute
+        self.bits = dict(execute(sqlalchemy.text(
+            "select name, bit from feature_bits")).fetchall())
+        if vendor is None:
+            rows = execute(sqlalchemy.text("""select id, name, feature_mask
+                from cpus order by id"""))
         else:
-            continue
-        cpu_count = db.query(
-            """select count(distinct cpus.id) from cpus join cpu_features on \
-                cpus.id=cpu_features.cpu where cpus.family={} and \
-                cpu_features.feature={};""".format(fam_id, feat_id))
-        cpu_count = cpu_count.next()
-        cpu_count = cpu_count['count(distinct cpus.id)']
-#        print("count: " + str(cpu_count) + " out of " + str(cpus_in_fam))
-        if cpu_count == cpus_in_fam:
-            ext_in_all.append(name)
-        elif cpu_count > 0:
-            ext_in_some.append(name)
-
-    print("all: " + ", ".join(ext_in_all))
-    print("some: " + ", ".join(ext_in_some))
+            rows = execute(sqlalchemy.text("""select cpus.id, cpus.name,
+                    cpus.feature_mask
+                from cpus join families on cpus.family = families.id
+                join vendors on families.vendor = vendors.id
+                where vendors.name = :vendor order by cpus.id"""),
+                {"vendor": vendor})
+        # `[(id, name, mask)]`, in id order like the queries above.
+        self.cpus = [(cpu, name, int.from_bytes(mask or b"", "little"))
+            for (cpu, name, mask) in rows.fetchall()]
+
+    @staticmethod
+    def available(db):
+        """if `db` has masks at all. databases only get them when opened with
+        `open_db`, so one that's only been queried since might not."""
+        return "feature_bits" in db.tables
+
+    def covers(self, node):
+        """if every term of the parsed feature expression `node` is a bare
+        boolean feature name with a bit."""
+        return all(op is None and name in self.bits and
+                name in FEATURE_PLAN.bool_features
+            for (_, name, op, _) in feature_expression_terms(node))
+
+    def test(self, node):
+        """a function of a mask that's whether it matches `node`. an `and` of
+        names and `not` names, the usual case, is two ANDs."""
+        if node[0] == "term":
+            bit = 1 << self.bits[node[1]]
+            return lambda mask: mask & bit != 0
+        if node[0] == "not":
+            test = self.test(node[1])
+            return lambda mask: not test(mask)
+        if node[0] == "or":
+            tests = [self.test(child) for child in node[1]]
+            return lambda mask: any(test(mask) for test in tests)
+
+        want = 0
+        unwanted = 0
+        tests = []
+        for child in node[1]:
+            if child[0] == "term":
+                want |= 1 << self.bits[child[1]]
+            elif child[0] == "not" and child[1][0] == "term":
+                unwanted |= 1 << self.bits[child[1][1]]
+            else:
+                tests.append(self.test(child))
+        return lambda mask: mask & want == want and not mask & unwanted and \
+            all(test(mask) for test in tests)
+
+    def matching(self, node, negate=False):
+        """`(id, name)` of the cpus that match `node`, or with `negate`, that
+        don't."""
+        test = self.test(node)
+        return [(cpu, name) for (cpu, name, mask) in self.cpus
+            if test(mask) != negate]
+
+def feature_masks_for(db, vendor, node):
+    """a `FeatureMasks` for `db` if it can evaluate the parsed feature
+    expression `node`, or None if the query has to go through
+    `cpu_features`."""
+    if not FeatureMasks.available(db) or \
+            not all(op is None and name in FEATURE_PLAN.bool_features
+                for (_, name, op, _) in feature_expression_terms(node)):
+        return None
+    masks = FeatureMasks(db, vendor)
+    return masks if masks.covers(node) else None
+
+# what `feature_coverage` can group cpus by: the `cpus` column, and the table
+# it points into.
+COVERAGE_GROUPS = {
+    "family": "families",
+    "uarch": "uarches",
+}
+
+def coverage(cpus_with, cpus):
+    """"all", "some" or "none" of `cpus` cpus having a feature."""
+    if cpus_with == cpus:
+        return "all"
+    return "some" if cpus_with else "none"
+
+def coverage_counts(db, features):
+    """CTEs for coverage queries: `counts (family, uarch, feature, cpus_with)`
+    for the features that match `features`, a condition on `features`, and
+    `totals (family, uarch, cpus)`. these read `coverage` if `db` has it, or
+    count `cpu_features` for databases that have only been queried since
+    before there was one."""
+    if "coverage" in db.tables:
+        return """with counts as (
+                select family, uarch, feature, cpus_with from coverage
+                where feature in (select id from features where {})),
+            totals as (select family, uarch, max(cpus_total) as cpus
+                from coverage group by family, uarch)""".format(features)
+    return """with counts as (
+            select cpus.family, ifnull(cpus.uarch, 0) as uarch,
+                cpu_features.feature, count(*) as cpus_with
+            from cpu_features join cpus on cpus.id = cpu_features.cpu
+            where cpus.family is not NULL and cpu_features.feature in
+                (select id from features where {})
+            group by 1, 2, 3),
+        totals as (select family, ifnull(uarch, 0) as uarch, count(*) as cpus
+            from cpus where family is not NULL group by 1, 2)""".format(
+                features)
+
+def feature_coverage(db, names, by="family", vendor=None, group=None):
+    """how many cpus of each family (or uarch, with `by`) have each of the
+    boolean features `names`: `[(name, cpus, {feature: cpus with it})]`, in id
+    order. `vendor` or `group`, a family or uarch name, limits which groups
+    there are. this is a single query over `coverage`, so it takes about as
+    long however many cpus there are."""
+    table = COVERAGE_GROUPS[by]
+    params = dict(("n{}".format(i), name) for (i, name) in enumerate(names))
+    where = ""
+    if vendor is not None:
+        params["vendor"] = vendor
+        where += """ and {0}.family in (select families.id from families
+            join vendors on vendors.id = families.vendor
+            where vendors.name = :vendor)"""
+    if group is not None:
+        params["grp"] = group
+        where += " and {}.name = :grp".format(table)
+    ctes = coverage_counts(db, "features.value = 1 and features.name in "
+        "({})".format(", ".join(":n{}".format(i) for i in range(len(names)))))
+    # NULL `feature` rows are the totals. they're read as plain tuples, like
+    # `FeatureMasks` does, since there's a row for every group and feature.
+    rows = db.executable.execute(sqlalchemy.text(ctes + """
+        select {0}.id, {0}.name, NULL as feature, sum(cpus) as cpus
+        from totals join {0} on {0}.id = totals.{1}
+        where 1 {2}
+        group by {0}.id
+        union all
+        select {0}.id, {0}.name, features.name as feature,
+            sum(cpus_with) as cpus
+        from features join counts on counts.feature = features.id
+        join {0} on {0}.id = counts.{1}
+        where 1 {3}
+        group by {0}.id, features.name
+        order by 1""".format(table, by, where.format("totals"),
+            where.format("counts"))), params)
+
+    totals = {}
+    counts = {}
+    for (group_id, name, feature, cpus) in rows.fetchall():
+        if feature is None:
+            totals[group_id] = (name, cpus)
+        else:
+            counts.setdefault(group_id, {})[feature] = cpus
+    return [(name, cpus, counts.get(group_id, {}))
+        for (group_id, (name, cpus)) in totals.items()]
+
+def feature_matrix_names(features):
+    """the boolean features a matrix is over: `features`, if any are given, or
+    else every boolean feature."""
+    for name in features:
+        if name not in FEATURE_PLAN.bool_features:
+            raise Exception("'{}' isn't a boolean feature".format(name))
+    return features or FEATURE_PLAN.bool_features
+
+def feature_matrix(dbpath, vendor, features, by="family", format="table",
+        transitioning=False, out=sys.stdout):
+    """print which of `features` (every boolean feature, if empty) all, some or
+    none of each family's cpus have, as a table, CSV or JSON. with
+    `transitioning`, print the families each feature is in some but not all
+    of instead, which is `families-transitioning` for every feature at once."""
+    db = open_query_db(dbpath)
+    names = feature_matrix_names(features)
+    groups = feature_coverage(db, names, by=by, vendor=vendor)
+
+    if transitioning:
+        partial = dict((name, [group for (group, cpus, counts) in groups
+                if coverage(counts.get(name, 0), cpus) == "some"])
+            for name in names)
+        partial = dict((name, found) for (name, found) in partial.items()
+            if found)
+        if format == "json":
+            json.dump(partial, out, indent=2)
+            out.write("\n")
+        elif format == "csv":
+            writer = csv.writer(out)
+            writer.writerow(["feature", by])
+            for (name, found) in partial.items():
+                for group in found:
+                    writer.writerow([name, group])
+        else:
+            for (name, found) in partial.items():
+                out.write("{}: {}\n".format(name, ", ".join(found)))
+        return
+
+    if format == "json":
+        json.dump([{
+            by: group,
+            "cpus": cpus,
+            "features": dict((name, counts.get(name, 0)) for name in names),
+        } for (group, cpus, counts) in groups], out, indent=2)
+        out.write("\n")
+    elif format == "csv":
+        writer = csv.writer(out)
+        writer.writerow([by, "feature", "cpus_with", "cpus", "coverage"])
+        for (group, cpus, counts) in groups:
+            for name in names:
+                cpus_with = counts.get(name, 0)
+                writer.writerow([group, name, cpus_with, cpus,
+                    coverage(cpus_with, cpus)])
+    else:
+        for (group, cpus, counts) in groups:
+            out.write("{} ({} cpus)\n".format(group, cpus))
+            for kind in ("all", "some", "none"):
+                found = ["{} ({})".format(name, counts[name])
+                        if kind == "some" else name
+                    for name in names
+                    if coverage(counts.get(name, 0), cpus) == kind]
+                if found:
+                    out.write("  {}: {}\n".format(kind, ", ".join(found)))
+
+def features_in_family(dbpath, vendor, family):
+    """the ISA extensions all and some of `family`'s cpus have."""
+    db = open_query_db(dbpath)
+    names = list(dict.fromkeys(ext.shortname for ext in ISA_EXTENSIONS))
+    groups = feature_coverage(db, names, vendor=vendor,
+        group=" ".join(family))
+    if not groups:
+        raise Exception("no cpus in family '{}'".format(" ".join(family)))
+    (_, cpus, counts) = groups[0]
+
+    print("all: " + ", ".join(name for name in names
+        if coverage(counts.get(name, 0), cpus) == "all"))
+    print("some: " + ", ".join(name for name in names
+        if coverage(counts.get(name, 0), cpus) == "some"))
 
 def families_with(dbpath, vendor, features):
-    db = dataset.connect("sqlite:///{}".format(dbpath))
-    families = db.query(families_with_query(vendor, features))
-    for family in families:
-        print(family['name'])
+    print_families(dbpath, vendor, features, "with", families_with_query)
 
 def families_without(dbpath, vendor, features):
-    db = dataset.connect("sqlite:///{}".format(dbpath))
-    families = db.query(families_without_query(vendor, features))
-    for family in families:
-        print(family['name'])
+    print_families(dbpath, vendor, features, "without",
+        families_without_query)
 
 def families_transitioning(dbpath, vendor, features):
-    db = dataset.connect("sqlite:///{}".format(dbpath))
-    families = db.query(families_transitioning_query(vendor, features))
-    for family in families:
-        print(family['name'])
-
-def cpus_with(dbpath, vendor, features):
-    db = dataset.connect("sqlite:///{}".format(dbpath))
-    cpus = db.query(cpus_with_query(vendor, features))
-    for cpu in cpus:
+    print_families(dbpath, vendor, features, "transitioning",
+        families_transitioning_query)
+
+def cpus_with(dbpath, vendor, features, negate=False):
+    db = open_query_db(dbpath)
+    node = parse_feature_expression(features)
+    masks = feature_masks_for(db, vendor, node)
+    if masks is not None:
+        for (_, name) in masks.matching(node, negate=negate):
+            print(name)
+        return
+    query = cpus_without_query if negate else cpus_with_query
+    (query, params) = query(vendor, features)
+    for cpu in db.query(query, **params):
         print(cpu['name'])
 
 def cpus_without(dbpath, vendor, features):
-    db = dataset.connect("sqlite:///{}".format(dbpath))
-    cpus = db.query(cpus_without_query(vendor, features))
-    for cpu in cpus:
-        print(cpu['name'])
+    cpus_with(dbpath, vendor, features, negate=True)
+
 
+def pop_option(args, name, default=None):
+    """remove `name value` from `args` if present, returning `value`."""
+    if name in args:
+        i = args.index(name)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+    return default
 
-cmd = sys.argv[1]
+def pop_flag(args, name):
+    """remove `name` from `args` if present, returning whether it was."""
+    if name in args:
+        args.remove(name)
+        return True
+    return False
 
 searches = {
         "cpus-with": cpus_with,
@@ -1354,9 +4173,93 @@ searches = {
         "features-in-family": features_in_family
 }
 
-if cmd == "add":
-    add(sys.argv[2], sys.argv[3])
-else:
+def main():
+    cmd = sys.argv[1]
+
+    if cmd == "add" or cmd == "add-dir":
+        # `add <db> <file>` is the original single-file form, but any number of
+        # files, directories or globs are accepted so a whole corpus can be
+        # loaded without paying for a new process per file.
+        args = sys.argv[3:]
+        batch_size = int(pop_option(args, "--batch-size", 1000))
+        # `--jobs 0` means one parser per CPU.
+        jobs = int(pop_option(args, "--jobs", 1)) or os.cpu_count()
+        # which files in directories or archives to ingest.
+        pattern = pop_option(args, "--pattern", CPUID_FILE_PATTERN)
+        incremental = pop_flag(args, "--incremental")
+        if cmd == "add" and len(args) == 1 and os.path.isfile(args[0]) and \
+                not is_archive(args[0]) and not incremental:
+            add(sys.argv[2], args[0])
+        else:
+            add_many(sys.argv[2], args, batch_size=batch_size, jobs=jobs,
+                pattern=pattern, incremental=incremental)
+        return
+
+    if cmd == "watch":
+        args = sys.argv[4:]
+        jobs = int(pop_option(args, "--jobs", 1)) or os.cpu_count()
+        watch(sys.argv[2], sys.argv[3],
+            settle=float(pop_option(args, "--settle", 2.0)),
+            max_delay=float(pop_option(args, "--max-delay", 30.0)),
+            interval=float(pop_option(args, "--interval", 1.0)),
+            jobs=jobs,
+            pattern=pop_option(args, "--pattern", CPUID_FILE_PATTERN),
+            poll=pop_flag(args, "--poll"),
+            batch_size=int(pop_option(args, "--batch-size", 1000)))
+        return
+
+    if cmd == "rederive":
+        rederive(sys.argv[2])
+        return
+
+    if cmd == "core-types":
+        show_core_types(sys.argv[2], *sys.argv[3:4])
+        return
+
+    if cmd == "check-features":
+        (problems, notes) = FEATURE_PLAN.problems()
+        for problem in problems:
+            print(problem)
+        for note in notes:
+            print("note: " + note)
+        if problems:
+            sys.exit(1)
+        return
+
+    if cmd == "parse-bench":
+        args = sys.argv[2:]
+        repeat = int(pop_option(args, "--repeat", 1))
+        memory = pop_flag(args, "--memory")
+        parse_bench(args, repeat=repeat, memory=memory)
+        return
+
+    if cmd == "classify":
+        # `classify [--db <db>] [--vendor <vendor>] [<signature>...]`, reading
+        # signatures from stdin if none are given. without `--vendor`, each
+        # signature is a vendor then an eax.
+        args = sys.argv[2:]
+        dbpath = pop_option(args, "--db")
+        vendor = pop_option(args, "--vendor")
+        if vendor is None:
+            args = [" ".join(args[i:i + 2]) for i in range(0, len(args), 2)]
+        classify_signatures(dbpath, vendor, args or sys.stdin)
+        return
+
+    if cmd == "feature-matrix":
+        # `feature-matrix <db> [--by family|uarch] [--format table|csv|json]
+        # [--transitioning] [--vendor <vendor>] [<feature>...]`
+        args = sys.argv[3:]
+        by = pop_option(args, "--by", "family")
+        format = pop_option(args, "--format", "table")
+        vendor = pop_option(args, "--vendor")
+        transitioning = pop_flag(args, "--transitioning")
+        if by not in COVERAGE_GROUPS or format not in ("table", "csv", "json"):
+            raise Exception("--by is family or uarch, and --format is table, "
+                "csv or json")
+        feature_matrix(sys.argv[2], vendor, args, by=by, format=format,
+            transitioning=transitioning)
+        return
+
     # HELP: look the adhoc argument parsing is bad but...
     # anyway all the cpu/family commands should be able to limit the vendors
     # which they're concerned with
@@ -1372,3 +4275,6 @@ else:
         args = sys.argv[3:]
 
     op(dbpath, vendor, args)
+
+if __name__ == "__main__":
+    main()
@@ -1197,11 +1197,8 @@ create table "devices" (
   generally_available BOOLEAN,
   description TEXT
 );
-create table "features" (
-  id INTEGER PRIMARY KEY,
-  name TEXT NOT NULL,
-  value INTEGER
-);
+-- `features`, `cpus` and the rest of what ingest fills in are defined with the
+-- code that fills them in, in `INGEST_TABLES` in explode_features.py.
 
 -- *****************************************************************************
 -- ************************ INTEL MODEL AND FAMILY INFO ************************
@@ -0,0 +1,439 @@
+import re
+import shutil
+import sqlite3
+import struct
+
+import pytest
+
+import explode_features
+
+def copy_product_info(directory, monkeypatch):
+    """seed databases from a copy of `product_info.sql` in `directory`, so it
+    can be edited and its templates are built there."""
+    path = directory / "product_info.sql"
+    shutil.copy(explode_features.PRODUCT_INFO_SQL, path)
+    monkeypatch.setattr(explode_features, "PRODUCT_INFO_SQL", str(path))
+    return path
+
+@pytest.fixture
+def product_info(tmp_path, monkeypatch):
+    """the `copy_product_info` databases in the test are seeded from."""
+    return copy_product_info(tmp_path, monkeypatch)
+
+def cpuid_rows(vendor, brand, leaf1_eax, without=()):
+    """`(leaf, subleaf, (eax, ebx, ecx, edx))` for a made-up cpu: enough
+    leaves to be parsed, classified and have a few features, less the boolean
+    features named in `without`."""
+    (ebx, edx, ecx) = struct.unpack("<III", vendor.encode())
+    rows = [
+        (0x00000000, None, (0x10, ebx, ecx, edx)),
+        (0x00000001, None, (leaf1_eax, 0x00100800, 0x7ef8320b, 0x178bfbff)),
+        (0x00000007, 0, (0, 0x219c97a9, 0x0040068c, 0x10)),
+        (0x00000007, 1, (0, 0, 0, 0)),
+        (0x0000000d, 0, (0x207, 0x988, 0x988, 0)),
+        (0x0000000d, 1, (0xf, 0x348, 0x1800, 0)),
+        (0x80000000, None, (0x80000008, ebx, ecx, edx)),
+        (0x80000001, None, (leaf1_eax, 0x20000000, 0x75c237ff, 0x2fd3fbff)),
+    ]
+    text = brand.encode().ljust(48, b"\0")
+    for i in range(3):
+        rows.append((0x80000002 + i, None,
+            struct.unpack("<IIII", text[i * 16:(i + 1) * 16])))
+    rows.append((0x80000008, None, (0x3030, 0x111ef657, 0x500f, 0x10000)))
+    for feature in explode_features.FEATURES:
+        if feature.shortname not in without:
+            continue
+        for (i, (leaf, subleaf, regs)) in enumerate(rows):
+            if (leaf, subleaf) == (feature.leaf, feature.subleaf):
+                reg = explode_features.REGISTER_INDEX[feature.reg]
+                regs = list(regs)
+                regs[reg] &= ~(1 << feature.offset)
+                rows[i] = (leaf, subleaf, tuple(regs))
+    return rows
+
+def write_dump(path, vendor, brand, leaf1_eax, without=(), cpus=2):
+    """write an AIDA64 dump of a made-up cpu with `cpus` logical cpus, each
+    with an MSR or two, to `path`."""
+    lines = [
+        "------[ CPU Info ]------",
+        "",
+        "CPU Type          : {}".format(brand),
+        "CPUID Manufacturer: {}".format(vendor),
+        "",
+    ]
+    for cpu in range(cpus):
+        lines += ["------[ CPUID Registers / Logical CPU #{} ]------".format(
+            cpu), ""]
+        for (leaf, subleaf, regs) in cpuid_rows(vendor, brand, leaf1_eax,
+                without):
+            if leaf == 0x00000001:
+                # the APIC ID.
+                regs = (regs[0], regs[1] | (cpu << 24)) + regs[2:]
+            lines.append("CPUID {:08X}: {}{}".format(leaf,
+                "-".join("{:08X}".format(reg) for reg in regs),
+                "" if subleaf is None else " [SL {:02X}]".format(subleaf)))
+        lines.append("")
+    for cpu in range(cpus):
+        lines += [
+            "------[ MSR Registers / Logical CPU #{} ]------".format(cpu),
+            "",
+            # only the first logical cpu is the bootstrap processor.
+            "MSR 0000001B: 00000000-{:08X} [APIC_BASE]".format(
+                0xfee00900 if cpu == 0 else 0xfee00800),
+            "MSR C0010015: 00000000-09000011",
+            "",
+        ]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n".join(lines) + "\n")
+
+def test_features_check():
+    # what `check-features` exits non-zero for.
+    (problems, _) = explode_features.FEATURE_PLAN.problems()
+    assert problems == []
+
+def test_overlap_is_a_problem():
+    plan = explode_features.FeaturePlan(explode_features.FEATURES + [
+        explode_features.CPUIDBoolFeature("NotAVX2", "AVX2 again", 0x00000007,
+            "ebx", 5, subleaf=0),
+    ])
+    (problems, _) = plan.problems()
+    assert problems == ["AVX2 and NotAVX2 overlap at leaf 7h subleaf 0 ebx"]
+
+ZEN_3 = ("AuthenticAMD", "AMD Ryzen 9 5950X 16-Core Processor", 0x00a20f10)
+ZEN_4 = ("AuthenticAMD", "AMD Ryzen 9 7950X 16-Core Processor", 0x00a60f12)
+
+def add_dumps(tmp_path, cpus):
+    """a database in `tmp_path` with a dump of each of `cpus` added to it, as
+    `(vendor, brand, leaf1_eax)`."""
+    dbpath = str(tmp_path / "cpus.db")
+    for (i, cpu) in enumerate(cpus):
+        write_dump(tmp_path / "dumps" / "{}_CPUID.txt".format(i), *cpu)
+    explode_features.add_many(dbpath, [str(tmp_path / "dumps")])
+    return dbpath
+
+AM486_UARCH = """insert into uarches (family, name, description) select
+  id, "Am486", NULL from families where name="Am486";
+"""
+
+# what cpus' `family` and `uarch` point into.
+CLASSIFICATIONS = {"family": "families", "uarch": "uarches"}
+
+def classified(dbpath, column):
+    """`{cpu name: (id, name, feature value)}` of the `column` of
+    `CLASSIFICATIONS` each cpu is recorded as."""
+    connection = sqlite3.connect(dbpath)
+    rows = connection.execute("""select cpus.name, cpus.{0}, {1}.name,
+            features.value
+        from cpus join {1} on {1}.id = cpus.{0}
+        join cpu_features on cpu_features.cpu = cpus.id
+        join features on features.id = cpu_features.feature
+        where features.name = ?""".format(column, CLASSIFICATIONS[column]),
+        (column,)).fetchall()
+    connection.close()
+    return dict((row[0], row[1:]) for row in rows)
+
+def test_upgrade_across_an_id_shift(product_info, tmp_path):
+    # Zen 3 and Zen 4 are next to each other, so a uarch added before both
+    # moves Zen 3 onto Zen 4's old id, which `features` already has a row for.
+    dbpath = add_dumps(tmp_path, [ZEN_3, ZEN_4])
+    before = classified(dbpath, "uarch")
+    assert sorted(uarch for (_, uarch, _) in before.values()) == \
+        ["Zen 3", "Zen 4"]
+
+    product_info.write_text(product_info.read_text().replace(AM486_UARCH,
+        AM486_UARCH + """insert into uarches (family, name, description)
+            select id, "Am486 again", NULL from families where name="Am486";
+        """))
+    explode_features.open_db(dbpath).close()
+
+    after = classified(dbpath, "uarch")
+    assert after == dict((name, (uarch + 1, uarch_name, value + 1))
+        for (name, (uarch, uarch_name, value)) in before.items())
+    for (uarch, _, value) in after.values():
+        assert value == uarch
+
+AM486_FAMILY = """insert into families (name, description, vendor) values (
+  'Am486', NULL,
+"""
+
+def test_upgrade_from_an_older_seed(product_info, tmp_path):
+    # an older `product_info.sql` with a family and uarch that have since been
+    # taken out, ahead of every other.
+    current = product_info.read_text()
+    product_info.write_text(current.replace(AM486_FAMILY, """insert into
+        families (name, description, vendor) values ('Am386', NULL,
+            (select id from vendors where name="AMD"));
+        insert into uarches (family, name, description)
+            select id, "Am386", NULL from families where name="Am386";
+        """ + AM486_FAMILY))
+    dbpath = add_dumps(tmp_path, [ZEN_3, ZEN_4])
+    before = dict((column, classified(dbpath, column))
+        for column in CLASSIFICATIONS)
+
+    product_info.write_text(current)
+    explode_features.open_db(dbpath).close()
+
+    for (column, cpus) in before.items():
+        assert len(cpus) == 2
+        after = classified(dbpath, column)
+        assert after == dict((name, (old - 1, classification, value - 1))
+            for (name, (old, classification, value)) in cpus.items())
+        for (new, _, value) in after.values():
+            assert value == new
+
+def test_upgrade_schema_merges_features(product_info, tmp_path):
+    dbpath = add_dumps(tmp_path, [ZEN_3, ZEN_4])
+
+    # before `SCHEMA_VERSION` 1, nothing kept `features` unique, so the same
+    # feature could be recorded twice and each cpu point at either.
+    connection = sqlite3.connect(dbpath)
+    connection.executescript("""
+        pragma legacy_alter_table=ON;
+        alter table features rename to features_unique;
+        create table features (id INTEGER NOT NULL, name TEXT, value BIGINT,
+            PRIMARY KEY (id));
+        insert into features select * from features_unique;
+        drop table features_unique;
+        insert into features (name, value) values ('AVX2', 1);
+        update cpu_features set feature = last_insert_rowid()
+            where cpu = (select max(id) from cpus) and
+                feature = (select min(id) from features where name = 'AVX2');
+        delete from metadata where key = 'schema';
+        """)
+    connection.close()
+
+    explode_features.open_db(dbpath).close()
+
+    connection = sqlite3.connect(dbpath)
+    assert connection.execute("""select count(*) from features
+        where name = 'AVX2'""").fetchone() == (1,)
+    assert connection.execute("""select count(*) from cpu_features
+        join features on features.id = cpu_features.feature
+        where features.name = 'AVX2'""").fetchone() == (2,)
+    assert explode_features.schema_version(connection) == \
+        explode_features.SCHEMA_VERSION
+    connection.close()
+
+def test_ingest(product_info, tmp_path, monkeypatch):
+    dumps = tmp_path / "dumps"
+    write_dump(dumps / "0_CPUID.txt", *ZEN_3, without=("AVX2",))
+    (dumps / "1_CPUID.txt").write_text("not a dump\n")
+    write_dump(dumps / "2_CPUID.txt", *ZEN_4)
+    write_dump(dumps / "3_CPUID.txt", "GenuineIntel",
+        "Intel(R) Core(TM) i9-12900K", 0x00090672)
+    write_dump(dumps / "4_CPUID.txt", "AuthenticAMD",
+        "AMD Ryzen 9 7950X3D 16-Core Processor", 0x00a60f12, cpus=4)
+
+    # a dump that parses but can't be recorded, partway through writing it.
+    store_msrs = explode_features.store_msrs
+    def failing_store_msrs(db, cpu_id, info):
+        if "Intel" in info.proc_name():
+            raise Exception("can't store MSRs")
+        store_msrs(db, cpu_id, info)
+    monkeypatch.setattr(explode_features, "store_msrs", failing_store_msrs)
+
+    dbpath = str(tmp_path / "cpus.db")
+    db = explode_features.open_db(dbpath)
+    # batches of two, so the broken dumps are in a batch with ones that aren't.
+    # workers only parse, so the one writer is still this process.
+    explode_features.ingest(db, explode_features.iter_sources([str(dumps)]),
+        batch_size=2, jobs=2)
+    db.close()
+
+    connection = sqlite3.connect(dbpath)
+    cpus = dict(connection.execute("select name, id from cpus").fetchall())
+    assert sorted(cpus) == [
+        "AMD Ryzen 9 5950X 16-Core Processor",
+        "AMD Ryzen 9 7950X 16-Core Processor",
+        "AMD Ryzen 9 7950X3D 16-Core Processor",
+    ]
+    assert sorted(row[0] for row in connection.execute(
+        "select path from sources")) == [str(dumps / "{}_CPUID.txt".format(i))
+            for i in (0, 2, 4)]
+    # nothing the Intel dump wrote before it failed is left behind.
+    for table in ("cpu_features", "cpu_core_types", "msr_values"):
+        assert connection.execute("""select count(*) from {}
+            where cpu not in (select id from cpus)""".format(table)
+            ).fetchone() == (0,)
+
+    assert connection.execute("""select count(*) from (select distinct name,
+        value from features)""").fetchone() == \
+        connection.execute("select count(*) from features").fetchone()
+    avx2 = set(row[0] for row in connection.execute("""select cpus.name
+        from cpus join cpu_features on cpu_features.cpu = cpus.id
+        join features on features.id = cpu_features.feature
+        where features.name = 'AVX2' and features.value = 1"""))
+    assert avx2 == set(name for name in cpus if "7950X" in name)
+
+    msrs = connection.execute("""select msr, value, logical_cpus
+        from msr_values where cpu = ? order by msr, value""",
+        (cpus["AMD Ryzen 9 7950X3D 16-Core Processor"],)).fetchall()
+    assert msrs == [
+        (0x0000001b, 0xfee00800, "1-3"),
+        (0x0000001b, 0xfee00900, "0"),
+        (0xc0010015, 0x09000011, None),
+    ]
+    connection.close()
+
+@pytest.mark.parametrize(("args", "node"), [
+    (["AVX2"], ("term", "AVX2", None, None)),
+    # terms next to each other are and-ed, whether they're separate arguments
+    # or not.
+    (["AVX2 BMI2"], ("and", [("term", "AVX2", None, None),
+        ("term", "BMI2", None, None)])),
+    (["AVX2", "BMI2"], ("and", [("term", "AVX2", None, None),
+        ("term", "BMI2", None, None)])),
+    (["AVX2 and not BMI2 or SHA"], ("or", [
+        ("and", [("term", "AVX2", None, None),
+            ("not", ("term", "BMI2", None, None))]),
+        ("term", "SHA", None, None)])),
+    (["(AVX2 OR SHA) BMI2"], ("and", [
+        ("or", [("term", "AVX2", None, None), ("term", "SHA", None, None)]),
+        ("term", "BMI2", None, None)])),
+    # names and values with spaces in them.
+    (["base CCLK>=3000"], ("term", "base CCLK", ">=", 3000)),
+    (["family=Zen 3"], ("term", "family", "=", "Zen 3")),
+    (["family=Zen 3", "AVX2"], ("and", [("term", "family", "=", "Zen 3"),
+        ("term", "AVX2", None, None)])),
+    (['family="Zen 3" AVX2'], ("and", [("term", "family", "=", "Zen 3"),
+        ("term", "AVX2", None, None)])),
+    (["'max CCLK' between 3000 and 0x1000"],
+        ("term", "max CCLK", "between", (3000, 0x1000))),
+    (["AVX2 'max CCLK'<4000"], ("and", [("term", "AVX2", None, None),
+        ("term", "max CCLK", "<", 4000)])),
+    # an argument that's exactly a name is that name, parentheses and all.
+    (["TSC:CLK (numerator)"], ("term", "TSC:CLK (numerator)", None, None)),
+    (["vendor=AMD", "virtual!=1", "uarch=0x33"], ("and", [
+        ("term", "vendor", "=", "AMD"), ("term", "virtual", "!=", 1),
+        ("term", "uarch", "=", 0x33)])),
+])
+def test_parse_feature_expression(args, node):
+    assert explode_features.parse_feature_expression(args) == node
+
+@pytest.mark.parametrize(("args", "error"), [
+    ([], "no features given"),
+    (["AVX2 or"], "expected a feature name or value, found the end"),
+    (["(AVX2"], "missing )"),
+    (["AVX2)"], "unexpected )"),
+    (["AVX2="], "expected a feature name or value, found the end"),
+    (["'max CCLK' between 3000"], "expected 'and'"),
+    (["AVX2!"], "can't parse feature expression at '!'"),
+])
+def test_feature_expression_errors(args, error):
+    with pytest.raises(Exception, match=re.escape(error)):
+        explode_features.parse_feature_expression(args)
+
+INTEL = ("GenuineIntel", "Intel(R) Core(TM) i9-12900K", 0x00090672)
+
+@pytest.fixture(scope="module")
+def mixed_db(tmp_path_factory):
+    """a database of four cpus with different features, of different vendors,
+    families and uarches, which is only queried."""
+    tmp_path = tmp_path_factory.mktemp("mixed")
+    dumps = tmp_path / "dumps"
+    write_dump(dumps / "0_CPUID.txt", *ZEN_3, without=("AVX2", "SHA"))
+    write_dump(dumps / "1_CPUID.txt", *ZEN_4)
+    write_dump(dumps / "2_CPUID.txt", "AuthenticAMD",
+        "AMD Ryzen 9 7950X3D 16-Core Processor", 0x00a60f12, without=("BMI2",))
+    write_dump(dumps / "3_CPUID.txt", *INTEL, without=("SHA",))
+    dbpath = str(tmp_path / "cpus.db")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        copy_product_info(tmp_path, monkeypatch)
+        explode_features.add_many(dbpath, [str(dumps)])
+    return dbpath
+
+def cpus_matching(dbpath, args):
+    """the names of the cpus the compound select for `args` finds."""
+    params = {}
+    sql = explode_features.compile_feature_expression(
+        explode_features.parse_feature_expression(args), params)
+    connection = sqlite3.connect(dbpath)
+    names = sorted(row[0] for row in connection.execute("""select name from cpus
+        where id in ({})""".format(sql), params))
+    connection.close()
+    return names
+
+ZEN_3_NAME = ZEN_3[1]
+ZEN_4_NAMES = [ZEN_4[1], "AMD Ryzen 9 7950X3D 16-Core Processor"]
+AMD_NAMES = sorted([ZEN_3_NAME] + ZEN_4_NAMES)
+
+@pytest.mark.parametrize(("args", "names"), [
+    (["AVX2"], sorted(ZEN_4_NAMES + [INTEL[1]])),
+    (["not SHA"], [ZEN_3_NAME, INTEL[1]]),
+    (["vendor=Intel"], [INTEL[1]]),
+    (["vendor=AuthenticAMD"], AMD_NAMES),
+    (["vendor!=amd"], [INTEL[1]]),
+    (["family=zen 3"], AMD_NAMES),
+    (["uarch=Zen 4"], ZEN_4_NAMES),
+    (["uarch!=Zen 4"], sorted([ZEN_3_NAME, INTEL[1]])),
+    (["virtual=0"], sorted(AMD_NAMES + [INTEL[1]])),
+    (["family=Zen 3", "not BMI2"], [ZEN_4_NAMES[1]]),
+    (["ModelID between 1 and 6"], AMD_NAMES),
+    (["ExtendedModelID>=6 not uarch=Zen 4"], [INTEL[1]]),
+])
+def test_compile_feature_expression(mixed_db, args, names):
+    assert cpus_matching(mixed_db, args) == names
+
+@pytest.mark.parametrize(("args", "error"), [
+    (["AVX3"], "unknown feature 'AVX3'"),
+    (["family>3"], "family can only be compared with = or !="),
+    (["vendor AVX2"], "vendor needs a value"),
+    (["ModelID>=six"], "ModelID >= needs a number"),
+])
+def test_compile_feature_expression_errors(args, error):
+    with pytest.raises(Exception, match=re.escape(error)):
+        explode_features.compile_feature_expression(
+            explode_features.parse_feature_expression(args), {})
+
+@pytest.mark.parametrize("args", [
+    ["AVX2"],
+    ["not AVX2"],
+    ["AVX2 BMI2"],
+    ["AVX2 not SHA"],
+    ["AVX2 or not BMI2"],
+    ["not (SHA or BMI2)"],
+    ["(AVX2 and SHA) or not BMI2"],
+    ["BMI2 SHA not AVX2"],
+])
+@pytest.mark.parametrize("vendor", [None, "AMD", "Intel"])
+def test_feature_masks_match_queries(mixed_db, args, vendor):
+    # the same expression, evaluated over `feature_mask`s and compiled into a
+    # query of `cpu_features`.
+    db = explode_features.open_query_db(mixed_db)
+    node = explode_features.parse_feature_expression(args)
+    masks = explode_features.feature_masks_for(db, vendor, node)
+    assert masks is not None
+    for (query, negate) in ((explode_features.cpus_with_query, False),
+            (explode_features.cpus_without_query, True)):
+        (sql, params) = query(vendor, args)
+        assert masks.matching(node, negate=negate) == \
+            [(row["id"], row["name"]) for row in db.query(sql, **params)]
+    db.close()
+
+def coverage_rows(connection):
+    return connection.execute("""select * from coverage
+        order by family, uarch, feature""").fetchall()
+
+def test_coverage_matches_a_rebuild(product_info, tmp_path):
+    dumps = tmp_path / "dumps"
+    write_dump(dumps / "0_CPUID.txt", *ZEN_3, without=("AVX2",))
+    write_dump(dumps / "1_CPUID.txt", *ZEN_4)
+    write_dump(dumps / "2_CPUID.txt", *ZEN_4, without=("SHA",))
+    write_dump(dumps / "3_CPUID.txt", *INTEL)
+    # a cpu without a family, which isn't counted.
+    write_dump(dumps / "4_CPUID.txt", "CentaurHauls", "VIA Nano", 0x000006f2)
+    dbpath = str(tmp_path / "cpus.db")
+    explode_features.add_many(dbpath, [str(dumps)], incremental=True)
+
+    # one dump becomes a different cpu, and another a second reading of a cpu
+    # that's already there.
+    write_dump(dumps / "1_CPUID.txt", *ZEN_4, without=("AVX2", "BMI2"), cpus=4)
+    shutil.copy(dumps / "0_CPUID.txt", dumps / "2_CPUID.txt")
+    explode_features.add_many(dbpath, [str(dumps)], incremental=True)
+
+    connection = sqlite3.connect(dbpath)
+    assert connection.execute("select count(*) from cpus").fetchone() == (4,)
+    incremental = coverage_rows(connection)
+    explode_features.rebuild_coverage(connection.execute)
+    assert incremental == coverage_rows(connection)
+    connection.close()